@@ -1,9 +1,8 @@
+import os
 import traceback
 
 from flask import Flask, request, render_template, make_response
 from flask_restplus import Api, Resource, fields
-import google_auth
-import github_auth
 
 from exceptions import (
     InvalidTokenException,
@@ -20,12 +19,20 @@ from exceptions import (
     OneFieldAtATimeException,
     SoldOutException,
     TryingToResellTooManyTicketsException,
-    RemoveTicketFirstException
+    RemoveTicketFirstException,
+    ServiceUnavailableException
 )
 from users import UsersContext, Role, AccessType
 from events import EventsContext
 from tickets import TicketsContext
+import database
+import event_import
+from etags import conditional_get
+import read_cache
+from streaming import wants_stream
+import outbox
 from currencies import currencies
+from pagination import DEFAULT_LIMIT, MAX_LIMIT
 from phonenumbers.phonenumberutil import NumberParseException
 
 
@@ -35,9 +42,15 @@ api = Api()
 api.init_app(app)
 
 
-def catch_exceptions(func):
+def catch_exceptions(context, action):
+    """
+    Runs action on the object the context provides, as one unit of work: the request's
+    changes are committed if it succeeds and rolled back if it raises. Errors become
+    error responses.
+    """
     try:
-        ret_val = func()
+        with context as resource:
+            ret_val = action(resource)
     except AccountBlocked:
         return {"error": "Account blocked."}, 401
     except WrongUsernameOrPassword:
@@ -66,6 +79,8 @@ def catch_exceptions(func):
         return {"error": "You cannot resell that many tickets."}, 400
     except RemoveTicketFirstException:
         return {"error": "Cannot delete buyer when associated with ticket."}, 400
+    except ServiceUnavailableException:
+        return {"error": "Service unavailable, try again later."}, 503, {"Retry-After": "1"}
     except Exception as e:
         traceback.print_exc()
         return {"error": str(e)}, 500
@@ -84,13 +99,13 @@ class Register(Resource):
         ]),
     }))
     def post(self):
-        with UsersContext(request) as users:
-            return catch_exceptions(users.register)
+        return catch_exceptions(UsersContext(request), lambda users: users.register())
 
 
 @api.route("/google-device-auth-step-1")
 class GoogleAuth1(Resource):
     def get(self):
+        import google_auth  # Loaded on first use, like in users.py
         return google_auth.auth_1()
 
 
@@ -101,12 +116,14 @@ class GoogleAuth2(Resource):
     }))
     def post(self):
         device_code = request.get_json()["device_code"]
+        import google_auth
         return google_auth.auth_2(device_code)
 
 
 @api.route("/github-device-auth-step-1")
 class GoogleAuth1(Resource):
     def get(self):
+        import github_auth
         return github_auth.auth_1()
 
 
@@ -117,6 +134,7 @@ class GoogleAuth2(Resource):
     }))
     def post(self):
         device_code = request.get_json()["device_code"]
+        import github_auth
         return github_auth.auth_2(device_code)
 
 
@@ -139,8 +157,7 @@ class Login(Resource):
         'password': fields.String,
     }))
     def post(self):
-        with UsersContext(request) as users:
-            return catch_exceptions(users.login_user)
+        return catch_exceptions(UsersContext(request), lambda users: users.login_user())
 
 
 access_parser = api.parser()
@@ -152,6 +169,22 @@ access_parser.add_argument('access-type',
                                AccessType.github]),
                            location='headers')
 
+page_parser = api.parser()
+page_parser.add_argument('limit', type=int, location='args',
+                         help=f'Page size, at most {MAX_LIMIT} (default {DEFAULT_LIMIT})')
+page_parser.add_argument('after', location='args', help='Cursor from the "next" link of the previous page')
+page_parser.add_argument('sort', location='args')
+
+event_parser = page_parser.copy()
+event_parser.add_argument('from', location='args', help='Events at or after this ISO 8601 time')
+event_parser.add_argument('to', location='args', help='Events before this ISO 8601 time')
+event_parser.add_argument('organizer_id', type=int, location='args')
+event_parser.add_argument('currency_code', location='args', choices=currencies)
+event_parser.add_argument('min_price', location='args')
+event_parser.add_argument('max_price', location='args')
+event_parser.add_argument('available', location='args', choices=['true', 'false'],
+                          help='true for events with tickets left, false for sold out events')
+
 update_user = api.model('user', {
     'email': fields.String,
     'password': fields.String,
@@ -165,33 +198,36 @@ update_user = api.model('user', {
 @api.expect(access_parser)
 class Users(Resource):
     def get(self):
-        with UsersContext(request) as users:
-            return catch_exceptions(users.read_myself)
+        return catch_exceptions(UsersContext(request), lambda users: users.read_myself())
+
+
+@api.route("/metrics", methods=["GET"])
+@api.expect(access_parser)
+class Metrics(Resource):
+    def get(self):
+        return catch_exceptions(UsersContext(request), lambda users: users.read_metrics())
 
 
 @api.route("/users", methods=["GET"])
 @api.expect(access_parser)
 class Users(Resource):
+    @api.expect(page_parser)
     def get(self):
-        with UsersContext(request) as users:
-            return catch_exceptions(users.read)
+        return catch_exceptions(UsersContext(request), lambda users: users.read())
 
 
 @api.route("/users/<user_id>", methods=["GET", "PUT", "DELETE"])
 @api.expect(access_parser)
 class User(Resource):
     def get(self, user_id):
-        with UsersContext(request, user_id) as users:
-            return catch_exceptions(users.read)
+        return catch_exceptions(UsersContext(request, user_id), lambda users: users.read())
 
     def delete(self, user_id):
-        with UsersContext(request, user_id) as users:
-            return catch_exceptions(users.remove)
+        return catch_exceptions(UsersContext(request, user_id), lambda users: users.remove())
 
     @api.doc(body=update_user)
     def put(self, user_id):
-        with UsersContext(request, user_id) as users:
-            return catch_exceptions(users.update)
+        return catch_exceptions(UsersContext(request, user_id), lambda users: users.update())
 
 
 buyer = api.model('buyer', {
@@ -209,26 +245,38 @@ sell_ticket = api.model('ticket', {
 @api.route("/sold-tickets", methods=["GET", "POST"])
 @api.expect(access_parser)
 class Tickets(Resource):
+    @api.expect(page_parser)
     def get(self):
-        with TicketsContext(request) as tickets:
-            return catch_exceptions(tickets.read)
+        return catch_exceptions(TicketsContext(request), lambda tickets: tickets.read())
 
     @api.doc(body=sell_ticket)
     def post(self):
-        with TicketsContext(request) as tickets:
-            return catch_exceptions(tickets.create)
+        return catch_exceptions(TicketsContext(request), lambda tickets: tickets.create())
+
+
+sell_tickets = api.model('tickets', {
+    'event_id': fields.Integer(required=True),
+    'seller_id': fields.Integer,
+    'buyers': fields.List(fields.Nested(buyer), required=True)
+})
+
+
+@api.route("/sold-tickets/bulk", methods=["POST"])
+@api.expect(access_parser)
+class BulkTickets(Resource):
+    @api.doc(body=sell_tickets)
+    def post(self):
+        return catch_exceptions(TicketsContext(request), lambda tickets: tickets.create_bulk())
 
 
 @api.route("/sold-tickets/<ticket_id>", methods=["GET", "DELETE"])
 @api.expect(access_parser)
 class Ticket(Resource):
     def get(self, ticket_id):
-        with TicketsContext(request, ticket_id) as tickets:
-            return catch_exceptions(tickets.read)
+        return catch_exceptions(TicketsContext(request, ticket_id), lambda tickets: tickets.read())
 
     def delete(self, ticket_id):
-        with TicketsContext(request, ticket_id) as tickets:
-            return catch_exceptions(tickets.remove)
+        return catch_exceptions(TicketsContext(request, ticket_id), lambda tickets: tickets.remove())
 
 
 reseller = api.model('reseller', {
@@ -257,57 +305,130 @@ update_event = api.model('event', {
 })
 
 
+def read_events(event_id=None):
+    """GET of the events or of one event, answered from the read cache when it has the response."""
+    key = None
+    if read_cache.cache and not wants_stream(request):
+        key = read_cache.cache.key(request, event_id)
+    if key is not None:
+        entry = read_cache.cache.get(key)
+        if entry is not None:
+            etag, body = entry
+            return conditional_get(request, etag, lambda: body)
+
+    def read(events):
+        etag = events.etag()
+
+        def read_body():
+            body = events.read()
+            if key is not None and etag is not None:
+                read_cache.cache.put(key, etag, body)
+            return body
+        return conditional_get(request, etag, read_body)
+
+    return catch_exceptions(EventsContext(request, event_id), read)
+
+
 @api.route("/events", methods=["GET", "POST"])
 @api.expect(access_parser)
 class Users(Resource):
+    @api.expect(event_parser)
     def get(self):
-        with EventsContext(request) as events:
-            return catch_exceptions(events.read)
+        return read_events()
 
     @api.doc(body=create_event)
     def post(self):
-        with EventsContext(request) as events:
-            return catch_exceptions(events.create_or_update)
+        return catch_exceptions(EventsContext(request), lambda events: events.create_or_update())
+
+
+import_parser = api.parser()
+import_parser.add_argument('format', location='args', choices=['csv', 'jsonl'],
+                           help='Defaults to csv for a text/csv body and jsonl otherwise')
+
+
+@api.route("/events/import", methods=["POST"])
+@api.expect(access_parser)
+class EventImport(Resource):
+    @api.expect(import_parser)
+    def post(self):
+        """Creates events from a CSV or JSON Lines body, one event per row."""
+        return catch_exceptions(EventsContext(request), lambda events: event_import.import_events(events))
+
+
+availability_parser = api.parser()
+availability_parser.add_argument('seller_id', type=int, location='args', help="Only this seller's allocation")
+batch_availability_parser = availability_parser.copy()
+batch_availability_parser.add_argument('event_ids', location='args', required=True,
+                                       help='Comma separated, at most 500')
+
+
+@api.route("/events/availability", methods=["GET"])
+class EventsAvailability(Resource):
+    @api.expect(batch_availability_parser)
+    def get(self):
+        """Tickets left for each of the events, in total and per seller."""
+        return catch_exceptions(EventsContext(request), lambda events: events.availability_batch())
+
+
+@api.route("/events/<event_id>/availability", methods=["GET"])
+class EventAvailability(Resource):
+    @api.expect(availability_parser)
+    def get(self, event_id):
+        """Tickets left for the event, in total and per seller."""
+        return catch_exceptions(EventsContext(request, event_id), lambda events: conditional_get(
+            request, events.availability_etag(), events.availability))
+
+
+search_parser = event_parser.copy()
+search_parser.add_argument('q', location='args', required=True, help='Words that must all be in the title')
+search_parser.replace_argument('sort', location='args', help='rank (default), time or id')
+
+
+@api.route("/events/search", methods=["GET"])
+@api.expect(access_parser)
+class EventSearch(Resource):
+    @api.expect(search_parser)
+    def get(self):
+        """Events whose title has all the words of q, best matches first."""
+        return catch_exceptions(EventsContext(request), lambda events: events.search())
 
 
 @api.route("/events/<event_id>", methods=["GET", "PUT", "DELETE"])
 @api.expect(access_parser)
 class Users(Resource):
     def get(self, event_id):
-        with EventsContext(request, event_id) as events:
-            return catch_exceptions(events.read)
+        return read_events(event_id)
 
     @api.doc(body=update_event)
     def put(self, event_id):
-        with EventsContext(request, event_id) as events:
-            return catch_exceptions(events.create_or_update)
+        return catch_exceptions(EventsContext(request, event_id), lambda events: events.create_or_update())
 
     def delete(self, event_id):
-        with EventsContext(request, event_id) as events:
-            return catch_exceptions(events.remove)
+        return catch_exceptions(EventsContext(request, event_id), lambda events: events.remove())
 
 
 @api.route("/buyers", methods=["GET"])
 @api.expect(access_parser)
 class Users(Resource):
+    @api.expect(page_parser)
     def get(self):
-        with TicketsContext(request) as tickets:
-            return catch_exceptions(tickets.read_buyers)
+        return catch_exceptions(TicketsContext(request), lambda tickets: tickets.read_buyers())
 
 
 @api.route("/buyers/<buyer_id>", methods=["GET", "DELETE"])
 @api.expect(access_parser)
 class Users(Resource):
     def get(self, buyer_id):
-        with TicketsContext(request, buyer_id=buyer_id) as tickets:
-            return catch_exceptions(tickets.read_buyers)
+        return catch_exceptions(TicketsContext(request, buyer_id=buyer_id), lambda tickets: tickets.read_buyers())
 
     def delete(self, buyer_id):
-        with TicketsContext(request, buyer_id=buyer_id) as tickets:
-            return catch_exceptions(tickets.remove_buyer)
+        return catch_exceptions(TicketsContext(request, buyer_id=buyer_id), lambda tickets: tickets.remove_buyer())
 
 
 if __name__ == "__main__":
+    database.init_db()
     with UsersContext(None) as users:
         users.create_admin_user()
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":  # The reloader's child process, which serves requests
+        outbox.sender.start()
     app.run(host="0.0.0.0", port=5000, debug=True)
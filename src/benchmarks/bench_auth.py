@@ -0,0 +1,53 @@
+"""
+Latency of an authenticated request with the user's token version cached, i.e. authorized
+from the token's claims alone, and with it read from the database on every request.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_auth 2000
+
+The requests are GET /metrics as the admin through the Flask test client, against a file
+backed SQLite database.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory.name, 'bench.db')}"
+os.environ.setdefault("SECRET_KEY", "SECRET_KEY")
+os.environ.setdefault("INIT_ADMIN_EMAIL", "admin@localmail.com")
+os.environ.setdefault("ADMIN_PASSWORD", "password")
+
+import app  # noqa: E402  (the database module reads DATABASE_URL on import)
+import database  # noqa: E402
+import users  # noqa: E402
+
+
+def _measure(name, client, headers, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get("/metrics", headers=headers)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.json
+    timings.sort()
+    print(f"{name}: median {statistics.median(timings) * 1000:.3f} ms, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    database.recreate_db()
+    with users.UsersContext(None) as admin:
+        admin.create_admin_user()
+    client = app.app.test_client()
+    token = client.post("/login", json={
+        "email": os.environ["INIT_ADMIN_EMAIL"], "password": os.environ["ADMIN_PASSWORD"]}).json["auth_token"]
+    headers = {"access-token": token, "access-type": "email"}
+    users.token_versions = users.UserCache(ttl=0)
+    _measure("token version read from the database", client, headers, requests)
+    users.token_versions = users.UserCache()
+    _measure("claims only, token version cached   ", client, headers, requests)
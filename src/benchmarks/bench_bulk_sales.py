@@ -0,0 +1,65 @@
+"""
+Ticket sale throughput of POST /sold-tickets (one ticket per request) against
+POST /sold-tickets/bulk (one request per group booking).
+
+Run from the src directory:
+
+    python -m benchmarks.bench_bulk_sales 2000
+
+Both paths run through the Flask test client against a file backed SQLite database.
+"""
+import os
+import sys
+import tempfile
+import time
+
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory.name, 'bench.db')}"
+
+import app  # noqa: E402  (the database module reads DATABASE_URL on import)
+import database  # noqa: E402
+from database import User, Event  # noqa: E402
+from inventory import InventoryStorage  # noqa: E402
+from users import Role  # noqa: E402
+
+BUYER = {"name": "Joe Blogs", "phone": "+441234567890", "email": "joe@email.com"}
+
+
+def _setup(tickets):
+    database.recreate_db()
+    db_session = database.DBSession()
+    db_session.add(User(id=1, email="org@localmail.com", role=Role.organizer, login_fail_count=0))
+    db_session.flush()
+    event_obj = Event(id=1, title="bench", cent_price=1000, currency_code="GBP", number_of_tickets=tickets,
+                      organizer_id=1)
+    db_session.add(event_obj)
+    db_session.flush()
+    InventoryStorage(db_session).allocate(event_obj)
+    db_session.commit()
+    db_session.close()
+
+
+def _single(client, tickets):
+    for _ in range(tickets):
+        response = client.post("/sold-tickets", json={"event_id": 1, "seller_id": 1, "buyer": BUYER})
+        assert response.status_code == 200, response.json
+
+
+def _bulk(group_size):
+    def run(client, tickets):
+        for _ in range(tickets // group_size):
+            response = client.post("/sold-tickets/bulk", json={
+                "event_id": 1, "seller_id": 1, "buyers": [BUYER] * group_size})
+            assert response.status_code == 200, response.json
+    return run
+
+
+if __name__ == "__main__":
+    tickets = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for name, sell in [("single", _single), ("bulk of 10", _bulk(10)), ("bulk of 50", _bulk(50))]:
+        _setup(tickets)
+        client = app.app.test_client()
+        start = time.perf_counter()
+        sell(client, tickets)
+        seconds = time.perf_counter() - start
+        print(f"{name:<11} {tickets} tickets in {seconds:6.2f} s, {tickets / seconds:8.0f} tickets/s")
@@ -0,0 +1,84 @@
+"""
+Lookup latency on the hot columns before and after the indexes added by migration 1.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_lookups 10000 100000 1000000
+
+For each table size a file backed SQLite database is filled, the lookups are timed without
+indexes, the database is upgraded in place with migrations.upgrade() and the lookups are
+timed again.
+"""
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+import migrations
+from database import Base, User, SoldTicket, Event, Buyer
+from users import _Storage as UserStorage
+from tickets import _Storage as TicketStorage
+
+LOOKUPS_PER_RUN = 200
+
+
+def _fill(engine, rows):
+    users = [{"id": i, "email": f"user{i}@mail.com", "foreign_user_id": f"foreign-{i}", "login_fail_count": 0}
+             for i in range(1, rows + 1)]
+    engine.execute(User.__table__.insert(), users)
+    engine.execute(Event.__table__.insert(),
+                   [{"id": 1, "title": "bench", "organizer_id": 1, "number_of_tickets": rows}])
+    engine.execute(Buyer.__table__.insert(), [{"id": 1, "name": "bench", "email": "buyer@mail.com"}])
+    tickets = [{"event_id": 1, "buyer_id": 1, "seller_id": random.randint(1, rows)} for _ in range(rows)]
+    engine.execute(SoldTicket.__table__.insert(), tickets)
+
+
+def _drop_indexes(engine):
+    """Puts the database back to its pre-migration state."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            engine.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    engine.execute(text("DELETE FROM schema_version"))
+
+
+def _time_lookups(session, rows):
+    users = UserStorage(session)
+    tickets = TicketStorage(session)
+    ids = [random.randint(1, rows) for _ in range(LOOKUPS_PER_RUN)]
+    results = {}
+    for name, lookup in [
+        ("get_user_by_email", lambda i: users.get_user_by_email(f"user{i}@mail.com")),
+        ("foreign_user_id", lambda i: session.query(User.id, User.role).filter_by(foreign_user_id=f"foreign-{i}")
+            .first()),
+        ("ticket_count_for_seller", lambda i: tickets.ticket_count_for_seller(i)),
+    ]:
+        seconds = timeit.timeit(lambda: [lookup(i) for i in ids], number=1)
+        results[name] = seconds / LOOKUPS_PER_RUN * 1000
+    return results
+
+
+def run(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        migrations.upgrade(engine, Base.metadata)
+        _drop_indexes(engine)
+        _fill(engine, rows)
+        session = sessionmaker(bind=engine)()
+        before = _time_lookups(session, rows)
+        session.close()
+        migrations.upgrade(engine, Base.metadata)
+        session = sessionmaker(bind=engine)()
+        after = _time_lookups(session, rows)
+        session.close()
+        engine.dispose()
+    for name in before:
+        print(f"{rows:>9} rows  {name:<32} before {before[name]:9.3f} ms  after {after[name]:7.3f} ms")
+
+
+if __name__ == "__main__":
+    for size in sys.argv[1:] or ["10000", "100000", "1000000"]:
+        run(int(size))
@@ -0,0 +1,92 @@
+"""
+Login throughput against the latency of concurrent event reads, with password hashing
+on a pool as big as the number of login threads (as if hashing ran on the request threads)
+and on the default bounded pool.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_passwords 8 10
+
+for 8 threads logging in continuously for 10 seconds per run, while one more thread reads
+GET /events. Shed logins wait as long as Retry-After asks before trying again. Requests go through the Flask test client against a file backed SQLite database.
+"""
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory.name, 'bench.db')}"
+os.environ.setdefault("SECRET_KEY", "SECRET_KEY")
+
+import app  # noqa: E402  (the database module reads DATABASE_URL on import)
+import database  # noqa: E402
+import passwords  # noqa: E402
+from database import User, Event  # noqa: E402
+from users import Role  # noqa: E402
+
+
+def _setup(users):
+    database.recreate_db()
+    db_session = database.DBSession()
+    hashed_password = passwords.hash_password("password")
+    for user_id in range(1, users + 1):
+        db_session.add(User(id=user_id, email=f"user{user_id}@localmail.com", role=Role.organizer,
+                            account_verified=True, login_fail_count=0, hashed_password=hashed_password))
+    db_session.flush()
+    for event_id in range(1, 51):
+        db_session.add(Event(id=event_id, title="bench", cent_price=1000, currency_code="GBP",
+                             time=datetime.datetime(2099, 1, 1), number_of_tickets=100, organizer_id=1))
+    db_session.commit()
+    db_session.close()
+
+
+def _run(name, login_threads, seconds):
+    stop = threading.Event()
+    logins, shed, reads = [], [], []
+
+    def log_in(user_id):
+        client = app.app.test_client()
+        while not stop.is_set():
+            response = client.post("/login", json={"email": f"user{user_id}@localmail.com", "password": "password"})
+            if response.status_code == 200:
+                logins.append(response.status_code)
+            else:
+                shed.append(response.status_code)
+                time.sleep(float(response.headers["Retry-After"]))
+
+    def read():
+        client = app.app.test_client()
+        while not stop.is_set():
+            start = time.perf_counter()
+            response = client.get("/events?limit=50")
+            reads.append(time.perf_counter() - start)
+            assert response.status_code == 200
+
+    threads = [threading.Thread(target=log_in, args=(user_id,)) for user_id in range(1, login_threads + 1)]
+    threads.append(threading.Thread(target=read))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    reads.sort()
+    print(f"{name}: {len(logins) / seconds:.1f} logins/s, {len(shed) / seconds:.1f} shed/s, "
+          f"{len(reads) / seconds:.0f} event reads/s, read median {statistics.median(reads) * 1000:.1f} ms, "
+          f"p99 {reads[int(len(reads) * 0.99)] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    login_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    _setup(login_threads)
+    passwords.pool = passwords.HashPool(workers=login_threads, queue_limit=0)
+    _run(f"{login_threads} hashing threads", login_threads, seconds)
+    passwords.pool = passwords.HashPool()
+    _run(f"bounded pool of {passwords.HASH_WORKERS}, queue {passwords.HASH_QUEUE_LIMIT}", login_threads, seconds)
+    passwords.pool = passwords.HashPool(queue_limit=2)
+    _run(f"bounded pool of {passwords.HASH_WORKERS}, queue 2", login_threads, seconds)
@@ -0,0 +1,75 @@
+"""
+Latency of GET /events/search against a substring scan of every title.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_search 10000 100000 1000000
+
+Titles are made of random words, so some words are in many titles and some in few.
+"search" is the first page (100 events) of GET /events/search. "scan" is what clients did
+before, less the HTTP and JSON: read every title and keep those containing the words.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory.name, 'bench.db')}"
+
+import app  # noqa: E402  (the database module reads DATABASE_URL on import)
+import database  # noqa: E402
+from database import User, Event  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+REPEAT = 5
+COMMON = ["concert", "festival", "live", "night", "tour"]
+WORDS = [f"word{number}" for number in range(20000)]
+QUERIES = ["concert", "word123", "live word42", "nothing"]
+
+
+def _fill(rows):
+    engine = database.engine
+    engine.execute(Event.__table__.delete())
+    engine.execute(User.__table__.delete())
+    engine.execute(User.__table__.insert(), [{"id": 1, "email": "organizer@mail.com"}])
+    random.seed(1)
+    for start in range(0, rows, 100000):
+        engine.execute(Event.__table__.insert(), [
+            {"title": " ".join([random.choice(COMMON)] + random.sample(WORDS, 3)), "organizer_id": 1,
+             "cent_price": 1000, "currency_code": "GBP", "number_of_tickets": 10}
+            for _ in range(start, min(rows, start + 100000))])
+
+
+def _search(client, terms):
+    response = client.get("/events/search", query_string={"q": terms})
+    assert response.status_code == 200, response.json
+    return len(response.json["events"])
+
+
+def _scan(client, terms):
+    words = terms.lower().split()
+    with database.engine.connect() as connection:
+        titles = connection.execute(text("SELECT id, title FROM event")).fetchall()
+    return len([title for _, title in titles if all(word in title.lower() for word in words)])
+
+
+def _measure(find, client, terms):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        found = find(client, terms)
+    return (time.perf_counter() - start) / REPEAT * 1000, found
+
+
+if __name__ == "__main__":
+    database.init_db()
+    client = app.app.test_client()
+    for rows in [int(size) for size in sys.argv[1:] or ["10000", "100000", "1000000"]]:
+        start = time.perf_counter()
+        _fill(rows)
+        print(f"{rows:>8} events indexed in {time.perf_counter() - start:.1f} s")
+        for terms in QUERIES:
+            for name, find in [("search", _search), ("scan", _scan)]:
+                milliseconds, found = _measure(find, client, terms)
+                print(f"{rows:>8} events  {name:<6} {terms!r:<14} {milliseconds:8.2f} ms, {found} found")
@@ -0,0 +1,82 @@
+"""
+Rows per second serialized by the event listing, column projection versus ORM objects.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_serializers 1000 10000 100000
+
+"columns" is what GET /events does: select the event columns and serialize the rows with
+the precompiled serializer. "orm" is what it used to do: load Event objects with their
+resellers and copy each one's __dict__, popping the SQLAlchemy state.
+"""
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory.name, 'bench.db')}"
+
+import database  # noqa: E402  (the database module reads DATABASE_URL on import)
+from database import User, Event, ResoldEvent  # noqa: E402
+from serializers import EVENT, serialize_events  # noqa: E402
+from sqlalchemy.orm import selectinload  # noqa: E402
+
+
+def _fill(rows):
+    engine = database.engine
+    engine.execute(ResoldEvent.__table__.delete())
+    engine.execute(Event.__table__.delete())
+    engine.execute(User.__table__.delete())
+    engine.execute(User.__table__.insert(), [{"id": 1, "email": "organizer@mail.com"},
+                                             {"id": 2, "email": "reseller@mail.com"}])
+    time = datetime.datetime(2030, 1, 1)
+    engine.execute(Event.__table__.insert(), [
+        {"id": number, "title": f"Event {number}", "cent_price": 6070, "currency_code": "GBP",
+         "time": time, "number_of_tickets": 100, "organizer_id": 1} for number in range(1, rows + 1)])
+    engine.execute(ResoldEvent.__table__.insert(), [
+        {"event_id": number, "seller_id": 2, "number_of_tickets": 10} for number in range(1, rows + 1, 2)])
+
+
+def _columns(db_session):
+    return serialize_events(db_session, EVENT.query(db_session).order_by(Event.id).all())
+
+
+def _orm(db_session):
+    events = []
+    for event in db_session.query(Event).options(selectinload(Event.resellers)).order_by(Event.id):
+        entry = dict(vars(event))
+        entry.pop("_sa_instance_state")
+        resellers = entry.pop("resellers", [])
+        entry["price"] = str(entry.pop("cent_price") / 100)
+        entry["time"] = entry.pop("time").isoformat()
+        entry["resellers"] = []
+        for resold in resellers:
+            r_dict = dict(vars(resold))
+            r_dict.pop("_sa_instance_state")
+            r_dict.pop("event_id")
+            entry["resellers"].append(r_dict)
+        events.append(entry)
+    return events
+
+
+def _measure(serialize, rows, repeat=3):
+    best = None
+    for _ in range(repeat):
+        db_session = database.DBSession()
+        start = time.perf_counter()
+        assert len(serialize(db_session)) == rows
+        seconds = time.perf_counter() - start
+        db_session.close()
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+if __name__ == "__main__":
+    database.init_db()
+    for rows in [int(size) for size in sys.argv[1:] or ["1000", "10000", "100000"]]:
+        _fill(rows)
+        for name, serialize in [("columns", _columns), ("orm", _orm)]:
+            seconds = _measure(serialize, rows)
+            print(f"{rows:>7} events  {name:<8} {rows / seconds:10.0f} rows/s")
@@ -0,0 +1,57 @@
+"""
+Cold start time: importing the app, initialising the database and serving the first request,
+each run in a fresh interpreter. Exits with status 1 if the median import plus first request
+time is over TARGET_SECONDS, so the benchmark can be tracked over time.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_startup 5
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+TARGET_SECONDS = 1.0
+
+_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.database.init_db()
+initialised = time.perf_counter()
+response = app.app.test_client().get("/events")
+served = time.perf_counter()
+assert response.status_code == 200, response.json
+print(json.dumps({
+    "import": imported - start,
+    "init_db": initialised - imported,
+    "first_request": served - initialised,
+    "providers_loaded": "google.oauth2" in sys.modules or "github_auth" in sys.modules,
+}))
+"""
+
+
+def _run_once(database_url):
+    output = subprocess.run([sys.executable, "-c", _CHILD], env={**os.environ, "DATABASE_URL": database_url},
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        _run_once(database_url)  # Creates the schema and warms the OS file cache
+        results = [_run_once(database_url) for _ in range(runs)]
+    medians = {phase: statistics.median(result[phase] for result in results)
+               for phase in ["import", "init_db", "first_request"]}
+    for phase, seconds in medians.items():
+        print(f"{phase}: {seconds * 1000:.0f} ms")
+    print(f"OAuth providers loaded at start up: {any(result['providers_loaded'] for result in results)}")
+    total = medians["import"] + medians["first_request"]
+    print(f"import + first request: {total * 1000:.0f} ms, target {TARGET_SECONDS * 1000:.0f} ms")
+    sys.exit(0 if total <= TARGET_SECONDS else 1)
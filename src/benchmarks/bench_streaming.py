@@ -0,0 +1,80 @@
+"""
+Peak memory of exporting every sold ticket, streamed versus built as one list.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_streaming 10000 100000 1000000
+
+"streamed" is GET /sold-tickets?stream=true read chunk by chunk. "in memory" is what the
+endpoint used to do: load every row, build a list of dicts and serialize it in one go.
+Peak memory is measured with tracemalloc, so absolute numbers include its overhead.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory.name, 'bench.db')}"
+
+import app  # noqa: E402  (the database module reads DATABASE_URL on import)
+import database  # noqa: E402
+from database import User, Event, Buyer, SoldTicket  # noqa: E402
+
+
+def _fill(rows):
+    engine = database.engine
+    engine.execute(SoldTicket.__table__.delete())
+    engine.execute(Buyer.__table__.delete())
+    engine.execute(Event.__table__.delete())
+    engine.execute(User.__table__.delete())
+    engine.execute(User.__table__.insert(), [{"id": 1, "email": "seller@mail.com"}])
+    engine.execute(Event.__table__.insert(), [{"id": 1, "title": "bench", "number_of_tickets": rows}])
+    engine.execute(Buyer.__table__.insert(), [{"id": 1, "name": "bench", "email": "buyer@mail.com"}])
+    for start in range(0, rows, 100000):
+        engine.execute(SoldTicket.__table__.insert(),
+                       [{"event_id": 1, "buyer_id": 1, "seller_id": 1} for _ in range(start, min(rows, start + 100000))])
+
+
+def _streamed():
+    client = app.app.test_client()
+    response = client.get("/sold-tickets?stream=true", buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    return size
+
+
+def _in_memory():
+    db_session = database.DBSession()
+    tickets = []
+    for ticket in db_session.query(SoldTicket).all():
+        entry = dict(vars(ticket))
+        entry.pop("_sa_instance_state")
+        tickets.append(entry)
+    size = len(json.dumps({"tickets": tickets}))
+    db_session.close()
+    return size
+
+
+def _measure(export):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = export()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size, seconds, peak
+
+
+if __name__ == "__main__":
+    database.init_db()
+    for rows in [int(size) for size in sys.argv[1:] or ["10000", "100000", "1000000"]]:
+        _fill(rows)
+        for name, export in [("streamed", _streamed), ("in memory", _in_memory)]:
+            size, seconds, peak = _measure(export)
+            print(f"{rows:>9} rows  {name:<10} {size / 1e6:8.1f} MB of JSON in {seconds:6.1f} s,"
+                  f" peak {peak / 1e6:8.1f} MB")
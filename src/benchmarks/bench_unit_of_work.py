@@ -0,0 +1,81 @@
+"""
+Commits per request and ticket sales per second through the API.
+
+Run from the src directory:
+
+    python -m benchmarks.bench_unit_of_work 1000
+
+Requests go through the Flask test client against a file backed SQLite database, so every
+commit is a real WAL write.
+"""
+import os
+import sys
+import tempfile
+import time
+
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory.name, 'bench.db')}"
+
+from sqlalchemy import event  # noqa: E402
+
+import app  # noqa: E402  (the database module reads DATABASE_URL on import)
+import database  # noqa: E402
+from database import User, Event  # noqa: E402
+from inventory import InventoryStorage  # noqa: E402
+from users import Role  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+BUYER = {"name": "Joe Blogs", "phone": "+441234567890", "email": "joe@email.com"}
+
+
+class CommitCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(database.engine, "commit", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def _setup(tickets):
+    database.recreate_db()
+    db_session = database.DBSession()
+    db_session.add(User(id=1, email="org@localmail.com", role=Role.organizer, login_fail_count=0,
+                        account_verified=True, hashed_password=generate_password_hash("password")))
+    db_session.add(User(id=2, email="res1@localmail.com", role=Role.reseller, login_fail_count=0))
+    db_session.add(User(id=3, email="res2@localmail.com", role=Role.reseller, login_fail_count=0))
+    db_session.flush()
+    event_obj = Event(id=1, title="bench", cent_price=1000, currency_code="GBP", number_of_tickets=tickets,
+                      organizer_id=1)
+    db_session.add(event_obj)
+    db_session.flush()
+    InventoryStorage(db_session).allocate(event_obj)
+    db_session.commit()
+    db_session.close()
+
+
+def _measure(name, requests, send):
+    commits = CommitCounter()
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = send()
+        assert response.status_code == 200, response.json
+    seconds = time.perf_counter() - start
+    print(f"{requests} {name}: {commits.count / requests:.2f} commits per request, {requests / seconds:.0f} requests/s")
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    os.environ.setdefault("SECRET_KEY", "SECRET_KEY")
+    _setup(requests)
+    client = app.app.test_client()
+    _measure("ticket sales", requests,
+             lambda: client.post("/sold-tickets", json={"event_id": 1, "seller_id": 1, "buyer": BUYER}))
+    token = client.post("/login", json={"email": "org@localmail.com", "password": "password"}).json["auth_token"]
+    new_event = {
+        "title": "bench", "price": "10", "currency_code": "GBP", "time": "2099-01-01T20:00:00",
+        "number_of_tickets": 100, "resellers": [{"seller_id": 2, "number_of_tickets": 10},
+                                                {"seller_id": 3, "number_of_tickets": 10}]
+    }
+    _measure("event creations with two resellers", requests // 10,
+             lambda: client.post("/events", json=new_event, headers={"access-token": token, "access-type": "email"}))
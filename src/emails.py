@@ -1,4 +1,3 @@
-import smtplib
 from validate_email import validate_email
 from exceptions import (
     InvalidEmailAddress
@@ -7,7 +6,8 @@ from itsdangerous import URLSafeTimedSerializer
 import os
 
 
-def register(email):
+def register(email, outbox):
+    """Queues the activation email in the outbox, to be sent once the registration commits."""
     valid = validate_email(email_address=email, check_mx=False)
     if not valid:
         raise InvalidEmailAddress
@@ -16,24 +16,10 @@ def register(email):
     app_url = os.environ['APP_URL']  # http://localhost:5000
     activate_url = f"{app_url}/activate/{code}"
 
-    # server = smtplib.SMTP('localhost', 1025)
-    server = smtplib.SMTP(os.environ["SMTP_SERVER"], os.environ["SMTP_PORT"])
-    server.ehlo()
-    server.login('', '')
-
-    sent_from = 'no_reply@tickets.com'
-    to = email
     subject = 'Activate your account please.'
     body = f'Please activate by clicking' \
            f' {activate_url}'
-    email_text = f"""\
-    From: {sent_from}
-    To: {to}
-    Subject: {subject}
-
-    {body}
-    """
-    server.sendmail(sent_from, to, email_text)
+    outbox.add(email, subject, body)
 
 
 def activate(code):
@@ -0,0 +1,60 @@
+"""
+Conditional GET.
+
+Responses carry a strong ETag built from versions kept in the database rather than from
+the body, so a request whose If-None-Match still matches gets 304 Not Modified after
+reading only the version, without reading or serializing what it covers.
+"""
+import hashlib
+import threading
+
+from flask import Response
+from werkzeug.http import quote_etag
+
+import metrics
+
+
+class ETagStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.not_modified = 0
+
+    def record(self, not_modified):
+        with self._lock:
+            self.responses += 1
+            if not_modified:
+                self.not_modified += 1
+
+    def status(self):
+        return {"responses": self.responses, "not_modified": self.not_modified,
+                "hit_rate": round(self.not_modified / self.responses, 3) if self.responses else 0.0}
+
+
+stats = ETagStats()
+metrics.register("etags", lambda: stats.status())
+
+
+def query_digest(request):
+    """Distinguishes the pages and sort orders of a collection."""
+    return hashlib.sha1(request.query_string).hexdigest()[:16]
+
+
+def conditional_get(request, etag, read):
+    """
+    Returns 304 Not Modified if the request's If-None-Match has etag, otherwise what read()
+    returns with the ETag header added. An etag of None, for instance for an item that
+    doesn't exist, leaves the response to read().
+    """
+    if etag is None:
+        return read()
+    not_modified = request.if_none_match.contains_weak(etag)
+    stats.record(not_modified)
+    headers = {"ETag": quote_etag(etag)}
+    if not_modified:
+        return Response(status=304, headers=headers)
+    response = read()
+    if isinstance(response, Response):
+        response.headers.extend(headers)
+        return response
+    return response, 200, headers
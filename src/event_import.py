@@ -0,0 +1,193 @@
+"""
+Bulk import of events from CSV or JSON Lines.
+
+Rows are read and validated one at a time and written in batches, each batch in its own
+transaction, so files with tens of thousands of events are never held in memory. Rows that
+fail validation are skipped and reported by row number; the rest are imported.
+
+CSV files have a header row with the event fields (title, price, currency_code, time,
+number_of_tickets and optionally organizer_id). Reseller allocations go in a "resellers"
+column as JSON, for example [{"seller_id": 3, "number_of_tickets": 50}].
+
+Command line use, without authentication, against the database in DATABASE_URL:
+
+    python event_import.py season.csv --organizer-id 2
+"""
+import argparse
+import csv
+import json
+import sys
+
+from database import Event, ResoldEvent, User
+from currencies import currencies
+from events import parse_price, parse_time, parse_number_of_tickets, invalidate
+from exceptions import InvalidRequestException, NotAllowedException
+from inventory import InventoryStorage
+from users import Role
+from versions import VersionStorage, EVENTS
+
+BATCH_SIZE = 500
+CSV = "csv"
+JSON_LINES = "jsonl"
+
+
+def format_from_content_type(content_type):
+    if content_type and content_type.split(";")[0].strip() in ("text/csv", "application/csv"):
+        return CSV
+    return JSON_LINES
+
+
+def read_rows(lines, file_format):
+    """Yields (row number, row dict or None if it could not be parsed) for each data row."""
+    if file_format == CSV:
+        for row_number, row in enumerate(csv.DictReader(lines), start=1):
+            yield row_number, row
+    else:
+        row_number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row_number, row if isinstance(row, dict) else None
+
+
+class EventImport:
+    """
+    Imports events as the given user. Organizers' events default to themselves as organizer,
+    as with POST /events.
+    """
+
+    def __init__(self, db_session, user_id, batch_size=BATCH_SIZE):
+        self._db_session = db_session
+        self._user_id = user_id
+        self._batch_size = batch_size
+        self._inventory = InventoryStorage(db_session)
+        self._versions = VersionStorage(db_session)
+        self.imported = 0
+        self.errors = []
+
+    def run(self, rows):
+        batch = []
+        for row_number, row in rows:
+            try:
+                batch.append((row_number, self._parse(row)))
+            except InvalidRequestException as e:
+                self.errors.append({"row": row_number, "error": str(e) or "Invalid row."})
+            if len(batch) == self._batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+        return {"imported": self.imported, "failed": len(self.errors), "errors": self.errors}
+
+    def _parse(self, row):
+        if row is None:
+            raise InvalidRequestException("row is not valid JSON")
+        for field in ["title", "price", "currency_code", "time", "number_of_tickets"]:
+            if row.get(field) in (None, ""):
+                raise InvalidRequestException(f"{field} is required")
+        if row["currency_code"] not in currencies:
+            raise InvalidRequestException("currency_code is not a known currency")
+        number_of_tickets = parse_number_of_tickets(row["number_of_tickets"])
+        event_fields = {
+            "title": row["title"],
+            "cent_price": parse_price(row["price"]),
+            "currency_code": row["currency_code"],
+            "time": parse_time(row["time"]),
+            "number_of_tickets": number_of_tickets,
+            "organizer_id": _parse_id(row.get("organizer_id") or self._user_id, "organizer_id"),
+        }
+        resellers = _parse_resellers(row.get("resellers"))
+        if sum(number for _, number in resellers) > number_of_tickets:
+            raise InvalidRequestException("resellers are allocated more tickets than the event has")
+        return event_fields, resellers
+
+    def _write(self, batch):
+        """Writes a batch of parsed rows in one transaction, after checking the users they refer to exist."""
+        user_ids = set()
+        for _, (event_fields, resellers) in batch:
+            user_ids.add(event_fields["organizer_id"])
+            user_ids.update(seller_id for seller_id, _ in resellers)
+        existing = {user_id for user_id, in self._db_session.query(User.id).filter(User.id.in_(user_ids))}
+        imported = 0
+        for row_number, (event_fields, resellers) in batch:
+            missing = [user_id for user_id in [event_fields["organizer_id"]] + [s for s, _ in resellers]
+                       if user_id not in existing]
+            if missing:
+                self.errors.append({"row": row_number, "error": f"unknown user {missing[0]}"})
+                continue
+            event_obj = Event(**event_fields)
+            event_obj.resellers = [ResoldEvent(seller_id=seller_id, number_of_tickets=number)
+                                   for seller_id, number in resellers]
+            self._inventory.allocate(event_obj)
+            self._db_session.add(event_obj)
+            imported += 1
+        if imported:
+            self._versions.bump(EVENTS)
+            invalidate(self._db_session, listing=True)
+        self._db_session.commit()
+        self.imported += imported
+
+
+def _parse_id(raw_id, field):
+    try:
+        return int(raw_id)
+    except (TypeError, ValueError):
+        raise InvalidRequestException(f"{field} must be a user id")
+
+
+def _parse_resellers(raw_resellers):
+    if raw_resellers in (None, ""):
+        return []
+    if isinstance(raw_resellers, str):
+        try:
+            raw_resellers = json.loads(raw_resellers)
+        except ValueError:
+            raise InvalidRequestException("resellers must be a JSON list")
+    if not isinstance(raw_resellers, list):
+        raise InvalidRequestException("resellers must be a JSON list")
+    resellers = []
+    for reseller in raw_resellers:
+        if not isinstance(reseller, dict):
+            raise InvalidRequestException("resellers must be a JSON list")
+        resellers.append((_parse_id(reseller.get("seller_id"), "seller_id"),
+                          parse_number_of_tickets(reseller.get("number_of_tickets"))))
+    if len({seller_id for seller_id, _ in resellers}) != len(resellers):
+        raise InvalidRequestException("a reseller is listed more than once")
+    return resellers
+
+
+def import_events(events):
+    """Imports the events in the request body for the logged in admin or organizer."""
+    events.users.set_logged_in()
+    if events.users.logged_in_user.role not in [Role.admin, Role.organizer]:
+        raise NotAllowedException
+    request = events.request
+    file_format = request.args.get("format") or format_from_content_type(request.content_type)
+    if file_format not in (CSV, JSON_LINES):
+        raise InvalidRequestException
+    lines = (line.decode("utf-8") for line in request.stream)
+    event_import = EventImport(events.db_session, events.users.logged_in_user.user_id)
+    return event_import.run(read_rows(lines, file_format))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import events from a CSV or JSON Lines file.")
+    parser.add_argument("file")
+    parser.add_argument("--organizer-id", type=int, required=True,
+                        help="Organizer of rows that don't have an organizer_id")
+    parser.add_argument("--format", choices=[CSV, JSON_LINES],
+                        help="Defaults to csv for .csv files and jsonl otherwise")
+    args = parser.parse_args()
+    from database import DBSession
+    file_format = args.format or (CSV if args.file.endswith(".csv") else JSON_LINES)
+    db_session = DBSession()
+    with open(args.file, newline="") as f:
+        report = EventImport(db_session, args.organizer_id).run(read_rows(f, file_format))
+    db_session.close()
+    json.dump(report, sys.stdout, indent=2)
+    print()
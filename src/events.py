@@ -3,10 +3,97 @@ from decimal import Decimal
 from exceptions import InvalidRequestException, NotAllowedException, TryingToResellTooManyTicketsException, \
     UnknownItemException
 from users import UsersContext, Users, Role
+from inventory import InventoryStorage, availability
+from pagination import Page
+from etags import query_digest
+import read_cache
+import search
+from serializers import EVENT, serialize_events
+from streaming import wants_stream, stream_json
+from versions import VersionStorage, EVENTS
 import iso8601
 import datetime
 import pytz
 
+
+def parse_price(raw_price_value):
+    """Returns the price in cents."""
+    try:
+        return int(Decimal(raw_price_value) * 100)
+    except Exception as e:
+        print(e)
+        raise InvalidRequestException("price must be a decimal number")
+
+
+def parse_time(raw_time):
+    """Returns the time in UTC, without a timezone as the column keeps none. Times without an offset are UTC."""
+    try:
+        date_object = iso8601.parse_date(raw_time)
+    except Exception as e:
+        print(e)
+        raise InvalidRequestException("time must be an ISO 8601 date")
+    if date_object < datetime.datetime.now().replace(tzinfo=pytz.UTC):
+        raise InvalidRequestException("time must be in the future")
+    return date_object.astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+MAX_AVAILABILITY_EVENTS = 500
+
+
+def _parse_filter_time(raw_time):
+    """Any ISO 8601 time, past ones included, in UTC as stored."""
+    try:
+        date_object = iso8601.parse_date(raw_time)
+    except Exception as e:
+        print(e)
+        raise InvalidRequestException
+    return date_object.astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+def _parse_filter_id(raw_id):
+    try:
+        return int(raw_id)
+    except ValueError:
+        raise InvalidRequestException
+
+
+def event_filters(args):
+    """
+    SQL conditions for the filters of GET /events: from and to (the event time, from inclusive
+    and to exclusive), organizer_id, currency_code, min_price and max_price (inclusive) and
+    available (true for events with tickets left, false for sold out ones).
+    """
+    filters = []
+    if args.get("from"):
+        filters.append(Event.time >= _parse_filter_time(args["from"]))
+    if args.get("to"):
+        filters.append(Event.time < _parse_filter_time(args["to"]))
+    if args.get("organizer_id"):
+        filters.append(Event.organizer_id == _parse_filter_id(args["organizer_id"]))
+    if args.get("currency_code"):
+        filters.append(Event.currency_code == args["currency_code"])
+    if args.get("min_price"):
+        filters.append(Event.cent_price >= parse_price(args["min_price"]))
+    if args.get("max_price"):
+        filters.append(Event.cent_price <= parse_price(args["max_price"]))
+    if args.get("available"):
+        available = args["available"].lower()
+        if available not in ("true", "false"):
+            raise InvalidRequestException
+        filters.append(availability() if available == "true" else ~availability())
+    return filters
+
+
+def parse_number_of_tickets(raw_number):
+    try:
+        number = int(raw_number)
+    except (TypeError, ValueError):
+        raise InvalidRequestException("number_of_tickets must be a whole number")
+    if number <= 0:
+        raise InvalidRequestException("number_of_tickets must be positive")
+    return number
+
+
 class EventsContext:
     def __init__(self, request, event_id=None):
         self._request = request
@@ -26,40 +113,99 @@ class Events:
     def __init__(self, db_session, users: Users, request, event_id):
         self.storage = _Storage(db_session)
         self.resoldEvent = _ResoldEvent(db_session)
+        self.inventory = InventoryStorage(db_session)
+        self.versions = VersionStorage(db_session)
         self.db_session = db_session
         self.users = users
         self.request = request
         self.event_id = event_id
 
-    def database_to_json(self, event):
-        event.pop("_sa_instance_state")
-        event["price"] = str(event.pop("cent_price") / 100)
-        event["time"] = event.pop("time").isoformat()
-
-        resold_events = self.resoldEvent.get_by_event(event["id"])
-        if resold_events:
-            event["resellers"] = []
-        for resold in resold_events:
-            r_dict = vars(resold)
-            r_dict.pop("_sa_instance_state")
-            r_dict.pop("event_id")
-            event["resellers"].append(r_dict)
+    def etag(self):
+        """ETag of what read() returns, from the versions alone. None if the event doesn't exist."""
+        if self.event_id:
+            version = self.storage.version(self.event_id)
+            return None if version is None else f"event-{self.event_id}-{version}"
+        return f"events-{self.versions.get(EVENTS)}-{query_digest(self.request)}"
 
     def read(self):
         if self.event_id:
-            try:
-                e_dict = vars(self.storage.get(self.event_id))
-            except:
+            rows = EVENT.query(self.db_session).filter(Event.id == self.event_id).all()
+            if not rows:
                 raise UnknownItemException
-            self.database_to_json(e_dict)
-            return {"event": e_dict}
+            return {"event": serialize_events(self.db_session, rows)[0]}
+        filters = event_filters(self.request.args if self.request else {})
+        if wants_stream(self.request):
+            return stream_json("events", lambda db_session: _query_event_columns(db_session, filters),
+                               serialize_events)
         else:
-            ret_val = {"events": []}
-            for entry in self.storage.get_all():
-                e_dict = vars(entry)
-                self.database_to_json(e_dict)
-                ret_val["events"].append(e_dict)
-            return ret_val
+            page = Page(self.request, Event.id, sort_keys={"time": Event.time})
+            rows, cursor = page.fetch(EVENT.query(self.db_session).filter(*filters))
+            return page.add_next_link({"events": serialize_events(self.db_session, rows)}, cursor)
+
+    def search(self):
+        """Events whose title has every word of q, best matches first. Takes the filters of read()."""
+        terms = self.request.args.get("q", "").strip()
+        if not terms:
+            raise InvalidRequestException
+        ranked = search.ranked_events(self.db_session.get_bind().dialect.name, terms)
+        page = Page(self.request, Event.id, sort_keys={"rank": ranked.c.rank, "time": Event.time}, default_sort="rank")
+        query = EVENT.query(self.db_session).add_columns(ranked.c.rank).join(ranked, ranked.c.id == Event.id) \
+            .filter(*event_filters(self.request.args))
+        rows, cursor = page.fetch(query)
+        return page.add_next_link({"events": serialize_events(self.db_session, rows)}, cursor)
+
+    def availability(self):
+        """
+        Tickets left for the event, in total and per seller, from the inventory counters.
+        The seller_id parameter narrows it down to one seller's allocation.
+        """
+        rows = self._availability([self._availability_event_id()])
+        if not rows:
+            raise UnknownItemException
+        return rows[0]
+
+    def availability_etag(self):
+        """The event's version is bumped by every sale and refund."""
+        event_id = self._availability_event_id()
+        version = self.storage.version(event_id)
+        if version is None:
+            return None
+        return f"availability-{event_id}-{version}-{query_digest(self.request)}"
+
+    def _availability_event_id(self):
+        """The event id from the URL, which must be a number before it is compared with the id column."""
+        try:
+            return int(self.event_id)
+        except ValueError:
+            raise UnknownItemException
+
+    def availability_batch(self):
+        """availability() for every event in the comma separated event_ids parameter. Unknown events are left out."""
+        try:
+            event_ids = [int(event_id) for event_id in self.request.args.get("event_ids", "").split(",")]
+        except ValueError:
+            raise InvalidRequestException
+        if len(event_ids) > MAX_AVAILABILITY_EVENTS:
+            raise InvalidRequestException
+        return {"availability": self._availability(event_ids)}
+
+    def _availability(self, event_ids):
+        seller_id = self.request.args.get("seller_id")
+        if seller_id is not None:
+            try:
+                seller_id = int(seller_id)
+            except ValueError:
+                raise InvalidRequestException
+        sellers = {}
+        for row in self.inventory.counters(event_ids):
+            event_sellers = sellers.setdefault(row.event_id, [])
+            if seller_id is None or row.seller_id == seller_id:
+                event_sellers.append({"seller_id": row.seller_id, "allocated": row.allocated, "sold": row.sold,
+                                      "remaining": max(row.allocated - row.sold, 0)})
+        return [{"event_id": event_id,
+                 "remaining": sum(seller["remaining"] for seller in sellers[event_id]),
+                 "sellers": sellers[event_id]}
+                for event_id in dict.fromkeys(event_ids) if event_id in sellers]
 
     def create_or_update(self):
         self.users.set_logged_in()
@@ -68,22 +214,11 @@ class Events:
         body = self.request.json
         cent_price = None
         if "price" in body:
-            try:
-                raw_price_value = body["price"]
-                cent_price = int(Decimal(raw_price_value) * 100)
-            except Exception as e:
-                print(e)
-                raise InvalidRequestException
+            cent_price = parse_price(body["price"])
 
         date_object = None
         if "time" in body:
-            try:
-                date_object = iso8601.parse_date(body["time"])
-            except Exception as e:
-                print(e)
-                raise InvalidRequestException
-            if date_object < datetime.datetime.now().replace(tzinfo=pytz.UTC):
-                raise InvalidRequestException
+            date_object = parse_time(body["time"])
 
         organizer_id = None
         if "organizer_id" in body:
@@ -94,12 +229,7 @@ class Events:
             organizer_id = self.users.logged_in_user.user_id
 
         if "number_of_tickets" in body:
-            try:
-                x = int(body["number_of_tickets"])
-                if x <= 0:
-                    raise InvalidRequestException
-            except:
-                raise InvalidRequestException
+            parse_number_of_tickets(body["number_of_tickets"])
 
         if self.event_id:
             event_obj = self.storage.get(self.event_id)
@@ -115,7 +245,7 @@ class Events:
                 event_obj.currency_code = body["currency_code"]
             if "number_of_tickets" in body:
                 event_obj.number_of_tickets = body["number_of_tickets"]
-            self.storage.commit_changes()
+            self.storage.flush_changes()
         else:
             event_obj = Event(
                 title=body["title"],
@@ -130,6 +260,12 @@ class Events:
         if "resellers" in body:
             self.create_update_reseller(body["resellers"], event_obj)
 
+        self.inventory.allocate(event_obj)
+        if self.event_id:
+            event_obj.version = Event.version + 1
+        self.versions.bump(EVENTS)
+        invalidate(self.db_session, event_obj.id, listing=True)
+        self.storage.flush_changes()
         self.event_id = event_obj.id
         return self.read()
 
@@ -163,21 +299,33 @@ class Events:
             raise NotAllowedException
         ret = self.read()
         self.storage.remove(self.event_id)
+        self.versions.bump(EVENTS)
+        invalidate(self.db_session, self.event_id, listing=True)
         return {**ret, "message": "Event removed."}
 
 
 
+def invalidate(db_session, event_id=None, listing=False):
+    """Drops the cached reads of an event, and of the listings with listing, once the transaction commits."""
+    if read_cache.cache:
+        read_cache.cache.invalidate_after_commit(db_session, event_id, listing)
+
+
+def _query_event_columns(db_session, filters=()):
+    return EVENT.query(db_session).filter(*filters).order_by(Event.id)
+
+
 class _Storage:
     def __init__(self, db_session):
         self._db_session = db_session
 
     def remove(self, event_id):
         self._db_session.delete(self.get(event_id))
-        self._db_session.commit()
+        self._db_session.flush()
 
     def create(self, event_obj):
         self._db_session.add(event_obj)
-        self._db_session.commit()
+        self._db_session.flush()
 
     def get(self, event_id) -> Event:
         return self._db_session.query(Event).filter_by(id=event_id).first()
@@ -185,13 +333,21 @@ class _Storage:
     def get_all(self):
         return self._db_session.query(Event)
 
+    def version(self, event_id):
+        return self._db_session.query(Event.version).filter_by(id=event_id).scalar()
+
+    def bump_version(self, event_id):
+        """For changes that don't go through the event itself, such as ticket sales."""
+        self._db_session.query(Event).filter_by(id=event_id).update(
+            {Event.version: Event.version + 1}, synchronize_session=False)
+
     def update_field(self, event_id, field, value):
         event = self._db_session.query(Event).filter_by(id=event_id).first()
         setattr(event, field, value)
-        self._db_session.commit()
+        self._db_session.flush()
 
-    def commit_changes(self):
-        self._db_session.commit()
+    def flush_changes(self):
+        self._db_session.flush()
         
 class _ResoldEvent:
     def __init__(self, db_session):
@@ -199,11 +355,11 @@ class _ResoldEvent:
 
     def remove(self, event_id):
         self._db_session.delete(self.get(event_id))
-        self._db_session.commit()
+        self._db_session.flush()
 
     def create(self, event_obj):
         self._db_session.add(event_obj)
-        self._db_session.commit()
+        self._db_session.flush()
 
     def get_by_event(self, event_id):
         return self._db_session.query(ResoldEvent).filter_by(event_id=event_id)
@@ -218,9 +374,9 @@ class _ResoldEvent:
     def update_field(self, event_id, field, value):
         event = self._db_session.query(ResoldEvent).filter_by(id=event_id).first()
         setattr(event, field, value)
-        self._db_session.commit()
+        self._db_session.flush()
 
-    def commit_changes(self):
-        self._db_session.commit()
+    def flush_changes(self):
+        self._db_session.flush()
 
 
@@ -55,4 +55,8 @@ class TryingToResellTooManyTicketsException(Exception):
 
 
 class RemoveTicketFirstException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class ServiceUnavailableException(Exception):
+    pass
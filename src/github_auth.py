@@ -1,26 +1,32 @@
+import hashlib
+import threading
+import time
+
 import requests
-import yaml
+from cachetools import TTLCache
 from urllib.parse import parse_qsl
 
-from exceptions import InvalidTokenException
-
-with open("secrets.yaml") as f:
-    secrets = yaml.load(f, Loader=yaml.FullLoader)
+import http_client
+import metrics
+import oauth_secrets
+from exceptions import InvalidTokenException, ServiceUnavailableException
 
-client_id = secrets["Github client ID"]
-client_secret = secrets["Github client secret"]
+USER_URL = "https://api.github.com/user"
+CACHE_SIZE = 10000
+ACCOUNT_TTL = 300  # Seconds a token stays trusted without asking GitHub again
+REJECTED_TTL = 60
 
 
 def auth_1():
     response = requests.post("https://github.com/login/device/code", params={
-        "client_id": client_id,
+        "client_id": oauth_secrets.get("Github client ID"),
         "scope": "user:email", })
     return dict(parse_qsl(response.text))
 
 
 def auth_2(device_code):
     response = requests.post("https://github.com/login/oauth/access_token", params={
-        "client_id": client_id,
+        "client_id": oauth_secrets.get("Github client ID"),
         "device_code": device_code,
         "grant_type": "urn:ietf:params:oauth:grant-type:device_code"
     })
@@ -30,10 +36,83 @@ def auth_2(device_code):
         return {"error": "Not authorized."}, 403
 
 
+class TokenCache:
+    """
+    Bounded TTL caches of token hash to GitHub account id, and of token hashes GitHub rejected.
+    Tokens are kept hashed so the cache doesn't hold usable credentials.
+    """
+
+    def __init__(self, size=CACHE_SIZE, ttl=ACCOUNT_TTL, rejected_ttl=REJECTED_TTL, timer=time.monotonic):
+        self._lock = threading.Lock()
+        self._accounts = TTLCache(maxsize=size, ttl=ttl, timer=timer)
+        self._rejected = TTLCache(maxsize=size, ttl=rejected_ttl, timer=timer)
+        self.hits = 0
+        self.rejected_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the account id, or None if GitHub has to be asked. Raises if the token was rejected."""
+        with self._lock:
+            if key in self._accounts:
+                self.hits += 1
+                return self._accounts[key]
+            if key in self._rejected:
+                self.rejected_hits += 1
+                raise InvalidTokenException
+            self.misses += 1
+            return None
+
+    def put(self, key, account_id):
+        with self._lock:
+            self._accounts[key] = account_id
+
+    def reject(self, key):
+        with self._lock:
+            self._rejected[key] = True
+
+
+_tokens = TokenCache()
+breaker = http_client.CircuitBreaker()
+
+
 def token_to_account_id(token):
+    key = _tokens.key(token)
+    account_id = _tokens.get(key)
+    if account_id is not None:
+        return account_id
+    if not breaker.allow():
+        raise ServiceUnavailableException
+    try:
+        response = http_client.session.get(USER_URL, headers={'Authorization': f"token {token}"},
+                                           timeout=http_client.TIMEOUT)
+    except requests.RequestException as e:
+        print(e)
+        breaker.record_failure()
+        raise ServiceUnavailableException
+    if response.status_code == 401:
+        breaker.record_success()
+        _tokens.reject(key)
+        raise InvalidTokenException
+    if response.status_code != 200:
+        breaker.record_failure()
+        raise ServiceUnavailableException
+    breaker.record_success()
     try:
-        response = requests.get("https://api.github.com/user", headers={'Authorization': f"token {token}"})
-        return response.json()['id']
+        account_id = response.json()['id']
     except Exception as e:
         print(e)
-        raise InvalidTokenException
\ No newline at end of file
+        raise InvalidTokenException
+    _tokens.put(key, account_id)
+    return account_id
+
+
+def cache_status():
+    return {"token_hits": _tokens.hits, "rejected_token_hits": _tokens.rejected_hits,
+            "token_misses": _tokens.misses, "circuit": breaker.state, "circuit_rejected": breaker.rejected}
+
+
+metrics.register("github_auth", cache_status)
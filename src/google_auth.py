@@ -1,28 +1,35 @@
+import threading
+import time
+
 import requests
-import yaml
+from cachetools import LRUCache
 
 from google.oauth2 import id_token
 from google.auth.transport import requests as grequests
 
+import http_client
+import metrics
+import oauth_secrets
 from exceptions import InvalidTokenException
 
-with open("secrets.yaml") as f:
-    secrets = yaml.load(f, Loader=yaml.FullLoader)
-client_id = secrets["Google client ID"]
-client_secret = secrets["Google client secret"]
+TOKEN_CACHE_SIZE = 10000
+
+
+def client_id():
+    return oauth_secrets.get("Google client ID")
 
 
 def auth_1():
     response = requests.post("https://oauth2.googleapis.com/device/code", params={
-        "client_id": client_id,
+        "client_id": client_id(),
         "scope": "email profile", })
     return response.json()
 
 
 def auth_2(device_code):
     response = requests.post("https://oauth2.googleapis.com/token", params={
-        "client_id": client_id,
-        "client_secret": client_secret,
+        "client_id": client_id(),
+        "client_secret": oauth_secrets.get("Google client secret"),
         "code": device_code,
         "grant_type": "http://oauth.net/grant_type/device/1.0"
     })
@@ -32,11 +39,83 @@ def auth_2(device_code):
         return {"error": "Not authorized."}, 403
 
 
+class CachingRequest(grequests.Request):
+    """
+    Transport for the token verification that reuses GET responses, i.e. Google's signing
+    certs, for as long as their Cache-Control header allows.
+    """
+
+    def __init__(self, session, clock=time.monotonic):
+        super().__init__(session)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._responses = {}
+        self.fetches = 0
+
+    def __call__(self, url, method="GET", **kwargs):
+        if method != "GET":
+            return super().__call__(url, method=method, **kwargs)
+        with self._lock:
+            expires, response = self._responses.get(url, (0, None))
+        now = self._clock()
+        if response is not None and now < expires:
+            return response
+        kwargs.setdefault("timeout", http_client.TIMEOUT)
+        response = super().__call__(url, method=method, **kwargs)
+        with self._lock:
+            self.fetches += 1
+            if response.status == 200:
+                self._responses[url] = (now + http_client.max_age(response.headers), response)
+        return response
+
+
+class TokenCache:
+    """Bounded LRU of verified tokens to their account id, each kept until the token expires."""
+
+    def __init__(self, size=TOKEN_CACHE_SIZE, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = LRUCache(maxsize=size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        with self._lock:
+            account_id, expires = self._tokens.get(token, (None, 0))
+            if account_id is not None and self._clock() < expires:
+                self.hits += 1
+                return account_id
+            self._tokens.pop(token, None)
+            self.misses += 1
+            return None
+
+    def put(self, token, account_id, expires):
+        if expires is None:
+            return
+        with self._lock:
+            self._tokens[token] = (account_id, expires)
+
+
+_request = CachingRequest(http_client.session)
+_tokens = TokenCache()
+
+
 def token_to_account_id(token):
+    account_id = _tokens.get(token)
+    if account_id is not None:
+        return account_id
     try:
-        idinfo = id_token.verify_oauth2_token(token, grequests.Request(), client_id)
-        return idinfo["sub"]
+        idinfo = id_token.verify_oauth2_token(token, _request, client_id())
+        account_id = idinfo["sub"]
     except Exception as e:
         print(e)
         raise InvalidTokenException
+    _tokens.put(token, account_id, idinfo.get("exp"))
+    return account_id
+
+
+def cache_status():
+    return {"token_hits": _tokens.hits, "token_misses": _tokens.misses, "cert_fetches": _request.fetches}
+
 
+metrics.register("google_auth", cache_status)
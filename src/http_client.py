@@ -0,0 +1,87 @@
+"""
+Shared HTTP session and circuit breaker for calls to the OAuth providers.
+
+One session keeps the connections to each provider open between requests, so verifying a
+token doesn't pay for a new TCP and TLS handshake every time.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 10
+TIMEOUT = 5  # Seconds, for connecting and for each read
+
+
+def new_session(pool_size=POOL_SIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+session = new_session()
+
+
+def max_age(headers):
+    """Seconds a response may be reused for according to its Cache-Control and Age headers."""
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+    try:
+        return max(0, int(directives.get("max-age", 0)) - int(headers.get("Age", 0)))
+    except ValueError:
+        return 0
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing service for reset_timeout seconds once failure_threshold calls
+    in a row have failed, so a slow provider doesn't tie up every worker waiting on timeouts.
+    After that a single trial call is let through: success closes the circuit again and
+    failure keeps it open for another reset_timeout.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        return "half-open" if self._trial else "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial and self._clock() - self._opened_at >= self._reset_timeout:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self._failure_threshold:
+                self._opened_at = self._clock()
+                self._trial = False
@@ -0,0 +1,138 @@
+"""
+Per (event, seller) ticket counters.
+
+Allocations are recalculated whenever an event or its resellers change, and the sold
+counter is updated in the same transaction as the ticket insert or delete. Checking
+availability is then a read of a single row rather than counting sold tickets.
+
+Run "python inventory.py reconcile" to rebuild every counter from sold_ticket.
+"""
+import sys
+
+from sqlalchemy import select, func, and_, exists, bindparam
+
+from database import Event, ResoldEvent, SoldTicket, Inventory
+
+
+class InventoryStorage:
+    def __init__(self, db_session):
+        self._db_session = db_session
+
+    def get(self, event_id, seller_id) -> Inventory:
+        return self._db_session.query(Inventory).filter_by(event_id=event_id, seller_id=seller_id).first()
+
+    def pool_for_sale(self, event_obj, seller_id, is_reseller):
+        """
+        The seller whose row a sale counts against: their own row if they have one, otherwise
+        the organizer's. Resellers only sell from their own allocation. Refunds and
+        rebuild_counters pick the row the same way, so they undo what the sale counted.
+        """
+        if is_reseller or seller_id == event_obj.organizer_id or self.get(event_obj.id, seller_id):
+            return seller_id
+        return event_obj.organizer_id
+
+    def pool_for_refund(self, ticket_obj):
+        """The seller whose row a sold ticket was counted against, by the same rule as pool_for_sale."""
+        if self.get(ticket_obj.event_id, ticket_obj.seller_id):
+            return ticket_obj.seller_id
+        return self._db_session.query(Event.organizer_id).filter_by(id=ticket_obj.event_id).scalar()
+
+    def reserve(self, event_id, seller_id, count=1):
+        """
+        Takes tickets from a row, returning False if not enough are left. The check and the
+        increment are one conditional UPDATE, so concurrent sales can't both take the last ticket.
+        """
+        result = self._db_session.execute(
+            Inventory.__table__.update()
+            .where(and_(
+                Inventory.event_id == event_id,
+                Inventory.seller_id == seller_id,
+                Inventory.sold + count <= Inventory.allocated
+            ))
+            .values(sold=Inventory.sold + count)
+        )
+        return result.rowcount == 1
+
+    def counters(self, event_ids):
+        """The rows of the events in one query on the primary key, as (event_id, seller_id, allocated, sold)."""
+        return self._db_session.query(Inventory.event_id, Inventory.seller_id, Inventory.allocated, Inventory.sold) \
+            .filter(Inventory.event_id.in_(bindparam("event_ids", expanding=True))) \
+            .order_by(Inventory.event_id, Inventory.seller_id) \
+            .params(event_ids=list(event_ids)).all()
+
+    def has_availability(self, event_id):
+        return self._db_session.query(availability(event_id)).scalar()
+
+    def release(self, event_id, seller_id, count=1):
+        self._db_session.execute(
+            Inventory.__table__.update()
+            .where(and_(Inventory.event_id == event_id, Inventory.seller_id == seller_id))
+            .values(sold=Inventory.sold - count)
+        )
+
+    def allocate(self, event_obj):
+        """Recalculates the allocated counts of an event from its resellers and number of tickets."""
+        allocations = _allocations(
+            event_obj.organizer_id,
+            event_obj.number_of_tickets,
+            [(resold.seller_id, resold.number_of_tickets) for resold in event_obj.resellers]
+        )
+        rows = {row.seller_id: row for row in event_obj.inventory}
+        for seller_id, allocated in allocations.items():
+            if seller_id not in rows:
+                rows[seller_id] = Inventory(event_id=event_obj.id, seller_id=seller_id, sold=0)
+                event_obj.inventory.append(rows[seller_id])
+            rows[seller_id].allocated = allocated
+        for seller_id, row in rows.items():
+            if seller_id not in allocations:
+                # The organizer changed, so the old organizer's sales count against the new organizer's row.
+                rows[event_obj.organizer_id].sold += row.sold
+                event_obj.inventory.remove(row)
+
+
+def availability(event_id=Event.id):
+    """True if the event has a ticket left to sell. Correlated with the event row by default."""
+    return exists().where(and_(Inventory.event_id == event_id, Inventory.sold < Inventory.allocated))
+
+
+def _allocations(organizer_id, number_of_tickets, resellers):
+    allocations = {organizer_id: number_of_tickets}
+    for seller_id, number in resellers:
+        allocations[organizer_id] -= number
+        allocations[seller_id] = allocations.get(seller_id, 0) + number
+    return allocations
+
+
+def rebuild_counters(connection):
+    """Recreates every inventory row from event, resold_event and sold_ticket."""
+    events = {}
+    for event in connection.execute(select([Event.id, Event.organizer_id, Event.number_of_tickets])):
+        events[event.id] = (event.organizer_id, event.number_of_tickets or 0, [])
+    for resold in connection.execute(select([ResoldEvent.event_id, ResoldEvent.seller_id,
+                                             ResoldEvent.number_of_tickets])):
+        events[resold.event_id][2].append((resold.seller_id, resold.number_of_tickets))
+    counters = {}
+    for event_id, (organizer_id, number_of_tickets, resellers) in events.items():
+        for seller_id, allocated in _allocations(organizer_id, number_of_tickets, resellers).items():
+            counters[(event_id, seller_id)] = {"event_id": event_id, "seller_id": seller_id,
+                                               "allocated": allocated, "sold": 0}
+    sold = select([SoldTicket.event_id, SoldTicket.seller_id, func.count()]) \
+        .group_by(SoldTicket.event_id, SoldTicket.seller_id)
+    for event_id, seller_id, count in connection.execute(sold):
+        counter = counters.get((event_id, seller_id))
+        if counter is None:
+            counter = counters[(event_id, events[event_id][0])]
+        counter["sold"] += count
+    connection.execute(Inventory.__table__.delete())
+    if counters:
+        connection.execute(Inventory.__table__.insert(), list(counters.values()))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["reconcile"]:
+        print("Usage: python inventory.py reconcile")
+        sys.exit(1)
+    from database import engine
+    with engine.begin() as connection:
+        rebuild_counters(connection)
+    print("Inventory counters rebuilt.")
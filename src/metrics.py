@@ -0,0 +1,13 @@
+"""
+Registry of operational counters. Modules register a callable returning a dict of their
+current values and the /metrics endpoint reports all of them.
+"""
+_sources = {}
+
+
+def register(name, source):
+    _sources[name] = source
+
+
+def snapshot():
+    return {name: source() for name, source in _sources.items()}
@@ -0,0 +1,134 @@
+"""
+Versioned schema migrations.
+
+A brand new database gets the full schema straight from the models in database.py and is
+stamped with the latest version. An existing database has every migration newer than its
+recorded version applied in order, so deployments are upgraded in place.
+
+To change the schema, update the models and append a migration to MIGRATIONS that brings
+an older database to the same state. Migrations must work on both SQLite and Postgres.
+"""
+from sqlalchemy import text
+from sqlalchemy.engine.reflection import Inspector
+
+
+def _add_lookup_indexes(connection):
+    """Indexes for the columns used by logins, OAuth lookups and ticket sales."""
+    statements = [
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email ON "user" (email)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_foreign_user_id ON "user" (foreign_user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_event_organizer_id ON event (organizer_id)',
+        'CREATE INDEX IF NOT EXISTS ix_resold_event_event_id ON resold_event (event_id)',
+        'CREATE INDEX IF NOT EXISTS ix_sold_ticket_event_id ON sold_ticket (event_id)',
+        'CREATE INDEX IF NOT EXISTS ix_sold_ticket_buyer_id ON sold_ticket (buyer_id)',
+        'CREATE INDEX IF NOT EXISTS ix_sold_ticket_seller_id ON sold_ticket (seller_id)',
+        'CREATE INDEX IF NOT EXISTS ix_buyer_email ON buyer (email)',
+    ]
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def _add_event_time_index(connection):
+    """Backs sorting events by time."""
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_event_time ON event (time)'))
+
+
+def _add_inventory(connection):
+    """Per (event, seller) ticket counters, filled from the existing sales."""
+    from database import Inventory
+    from inventory import rebuild_counters
+    Inventory.__table__.create(connection, checkfirst=True)
+    rebuild_counters(connection)
+
+
+def _add_token_version(connection):
+    """Lets login tokens be revoked by bumping the user's version."""
+    columns = {column["name"] for column in Inspector.from_engine(connection).get_columns("user")}
+    if "token_version" not in columns:
+        connection.execute(text('ALTER TABLE "user" ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0'))
+
+
+def _add_email_outbox(connection):
+    """Emails are queued in the database and sent in the background."""
+    from database import EmailOutbox
+    EmailOutbox.__table__.create(connection, checkfirst=True)
+
+
+def _add_versions(connection):
+    """Versions behind the ETags of the events endpoints."""
+    from database import CollectionVersion
+    columns = {column["name"] for column in Inspector.from_engine(connection).get_columns("event")}
+    if "version" not in columns:
+        connection.execute(text('ALTER TABLE event ADD COLUMN version INTEGER NOT NULL DEFAULT 0'))
+    CollectionVersion.__table__.create(connection, checkfirst=True)
+
+
+def _add_event_filter_indexes(connection):
+    """Back the filters of GET /events. (organizer_id, time) replaces the index on organizer_id."""
+    statements = [
+        'CREATE INDEX IF NOT EXISTS ix_event_organizer_id_time ON event (organizer_id, time)',
+        'CREATE INDEX IF NOT EXISTS ix_event_currency_code_time ON event (currency_code, time)',
+        'CREATE INDEX IF NOT EXISTS ix_event_cent_price ON event (cent_price)',
+        'DROP INDEX IF EXISTS ix_event_organizer_id',
+    ]
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def _add_event_search(connection):
+    """Full text index of the event titles."""
+    import search
+    search.create_index(connection)
+    search.rebuild_index(connection)
+
+
+# (version, migration) pairs. Append only, never reorder or renumber.
+MIGRATIONS = [
+    (1, _add_lookup_indexes),
+    (2, _add_event_time_index),
+    (3, _add_inventory),
+    (4, _add_token_version),
+    (5, _add_email_outbox),
+    (6, _add_versions),
+    (7, _add_event_filter_indexes),
+    (8, _add_event_search),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    """Returns the applied schema version, or None if the database has no schema yet."""
+    tables = Inspector.from_engine(connection).get_table_names()
+    if "user" not in tables:
+        return None
+    if "schema_version" not in tables:
+        return 0  # Database created before migrations were introduced
+    version = connection.execute(text("SELECT max(version) FROM schema_version")).scalar()
+    return version or 0
+
+
+def _stamp(connection, version):
+    connection.execute(text("DELETE FROM schema_version"))
+    connection.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), version=version)
+
+
+def upgrade(engine, metadata):
+    """Creates the schema or brings an existing one up to LATEST_VERSION."""
+    with engine.begin() as connection:
+        version = current_version(connection)
+        if version is None:
+            metadata.create_all(connection)
+            _stamp(connection, LATEST_VERSION)
+            return
+        metadata.tables["schema_version"].create(connection, checkfirst=True)
+        for migration_version, migration in MIGRATIONS:
+            if migration_version > version:
+                migration(connection)
+                _stamp(connection, migration_version)
+
+
+if __name__ == "__main__":
+    import database
+    database.init_db()
+    print(f"Database at schema version {LATEST_VERSION}")
@@ -0,0 +1,16 @@
+"""
+OAuth client ids and secrets from secrets.yaml, read the first time one is needed rather
+than when the app starts.
+"""
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def _secrets():
+    import yaml
+    with open("secrets.yaml") as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def get(name):
+    return _secrets()[name]
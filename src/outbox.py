@@ -0,0 +1,207 @@
+"""
+Durable outbox for emails.
+
+Requests queue emails as rows of the email_outbox table in their own transaction, so an
+email goes out only if the request that queued it commits, and the request never waits on
+the mail server. OutboxSender sends the queued emails in batches in the background, over
+one SMTP connection that it keeps open between batches, retrying failed emails with
+exponential backoff. Delivery is at least once: an email sent just before the sender dies
+is sent again when it restarts.
+
+The sender runs in a thread of the API process (see app.py) or on its own:
+
+    python outbox.py
+"""
+import datetime
+import os
+import smtplib
+import threading
+import time
+import traceback
+from email.message import EmailMessage
+
+from sqlalchemy import event, func
+
+import metrics
+from database import DBSession, EmailOutbox
+
+SENDER = "no_reply@tickets.com"
+BATCH_SIZE = 50
+POLL_INTERVAL = 5  # Seconds between checks for due emails when no new email wakes the sender
+MAX_ATTEMPTS = 8
+BACKOFF = 5  # Seconds before an email's first retry, doubled for every retry after that
+MAX_BACKOFF = 300
+IDLE_TIMEOUT = 60  # Seconds an unused SMTP connection is kept open
+SMTP_TIMEOUT = 10
+
+_queued = threading.Event()  # Set when a request commits a new email
+
+
+def _wake(session):
+    _queued.set()
+
+
+class Outbox:
+    """Queues emails in the caller's transaction."""
+
+    def __init__(self, db_session):
+        self._db_session = db_session
+
+    def add(self, recipient, subject, body):
+        now = datetime.datetime.utcnow()
+        self._db_session.add(EmailOutbox(recipient=recipient, subject=subject, body=body,
+                                         created_at=now, next_attempt_at=now, attempts=0))
+        self._db_session.flush()
+        event.listen(self._db_session, "after_commit", _wake, once=True)
+
+
+class OutboxSender:
+    def __init__(self, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL, max_attempts=MAX_ATTEMPTS,
+                 backoff=BACKOFF, clock=datetime.datetime.utcnow):
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._clock = clock
+        self._connection = None
+        self._connection_used_at = 0
+        self._connection_failures = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        self.sent = 0
+        self.failed_attempts = 0
+        self.batches = 0
+        self.connections = 0
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="email-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        _queued.set()
+        if self._thread:
+            self._thread.join()
+        self._disconnect()
+
+    def run(self):
+        while not self._stopped.is_set():
+            _queued.clear()
+            try:
+                sent = self.send_batch()
+            except Exception:
+                traceback.print_exc()
+                sent = 0
+            if self._connection_failures:
+                self._stopped.wait(min(self._backoff * 2 ** (self._connection_failures - 1), MAX_BACKOFF))
+            elif sent < self._batch_size:  # Caught up, wait for the next email
+                _queued.wait(self._poll_interval)
+                if time.monotonic() - self._connection_used_at > IDLE_TIMEOUT:
+                    self._disconnect()
+
+    def send_batch(self):
+        """Sends up to batch_size emails that are due and returns how many were sent."""
+        db_session = DBSession()
+        try:
+            now = self._clock()
+            emails = db_session.query(EmailOutbox) \
+                .filter(EmailOutbox.next_attempt_at <= now) \
+                .order_by(EmailOutbox.next_attempt_at, EmailOutbox.id) \
+                .limit(self._batch_size) \
+                .with_for_update(skip_locked=True) \
+                .all()
+            sent = 0
+            for email in emails:
+                try:
+                    self._send(email)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    self._retry_later(email, e, now)  # A problem with this email only
+                    continue
+                except (smtplib.SMTPException, OSError) as e:
+                    self._retry_later(email, e, now)  # The server is unreachable, try the rest later
+                    self._connection = None
+                    self._connection_failures += 1
+                    break
+                self._connection_failures = 0
+                db_session.delete(email)
+                sent += 1
+            db_session.commit()
+            if emails:
+                self.batches += 1
+            self.sent += sent
+            return sent
+        finally:
+            db_session.close()
+
+    def _send(self, email):
+        message = EmailMessage()
+        message["From"] = SENDER
+        message["To"] = email.recipient
+        message["Subject"] = email.subject
+        message.set_content(email.body)
+        try:
+            self._connect().sendmail(SENDER, [email.recipient], message.as_string())
+        except smtplib.SMTPServerDisconnected:
+            self._connection = None  # Closed by the server while idle, reconnect once
+            self._connect().sendmail(SENDER, [email.recipient], message.as_string())
+        self._connection_used_at = time.monotonic()
+
+    def _connect(self):
+        if self._connection is None:
+            connection = smtplib.SMTP(os.environ["SMTP_SERVER"], os.environ["SMTP_PORT"], timeout=SMTP_TIMEOUT)
+            connection.ehlo()
+            if os.environ.get("SMTP_USERNAME"):
+                connection.login(os.environ["SMTP_USERNAME"], os.environ.get("SMTP_PASSWORD", ""))
+            self._connection = connection
+            self.connections += 1
+        return self._connection
+
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._connection = None
+
+    def _retry_later(self, email, error, now):
+        print(error)
+        self.failed_attempts += 1
+        email.attempts += 1
+        email.last_error = str(error)[:500]
+        if email.attempts >= self._max_attempts:
+            email.next_attempt_at = None  # Given up, kept for inspection
+        else:
+            delay = min(self._backoff * 2 ** (email.attempts - 1), MAX_BACKOFF)
+            email.next_attempt_at = now + datetime.timedelta(seconds=delay)
+
+    def status(self):
+        db_session = DBSession()
+        try:
+            pending, oldest = db_session.query(func.count(EmailOutbox.id), func.min(EmailOutbox.created_at)) \
+                .filter(EmailOutbox.next_attempt_at.isnot(None)).one()
+            failed = db_session.query(func.count(EmailOutbox.id)).filter(EmailOutbox.next_attempt_at.is_(None)).scalar()
+        finally:
+            db_session.close()
+        return {
+            "pending": pending,
+            "oldest_pending_seconds": (self._clock() - oldest).total_seconds() if oldest else 0,
+            "given_up": failed,
+            "sent": self.sent,
+            "failed_attempts": self.failed_attempts,
+            "batches": self.batches,
+            "connections": self.connections,
+            "running": self._thread is not None and self._thread.is_alive(),
+        }
+
+
+sender = OutboxSender()
+metrics.register("email_outbox", lambda: sender.status())
+
+
+if __name__ == "__main__":
+    try:
+        sender.run()
+    except KeyboardInterrupt:
+        sender._disconnect()
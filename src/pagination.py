@@ -0,0 +1,100 @@
+"""
+Keyset pagination for the collection endpoints.
+
+Pages are ordered by a sort key followed by the primary key. The cursor passed back as
+"after" is an opaque encoding of the last row's sort key and id, so fetching the next page
+is an index range scan from that point rather than an OFFSET over everything before it.
+"""
+import base64
+import datetime
+import json
+from urllib.parse import urlencode
+
+from sqlalchemy import and_, or_
+
+from exceptions import InvalidRequestException
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def encode_cursor(values):
+    encoded = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode()).decode()
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(columns):
+            raise ValueError
+        return [
+            datetime.datetime.fromisoformat(value) if column.type.python_type is datetime.datetime else value
+            for value, column in zip(values, columns)
+        ]
+    except Exception as e:
+        print(e)
+        raise InvalidRequestException
+
+
+class Page:
+    """
+    Reads limit, after and sort from the query string. sort_keys maps the sort names a
+    collection allows to indexed columns, or to a column of a subquery such as a search rank;
+    the primary key is always the tie breaker.
+    """
+
+    def __init__(self, request, id_column, sort_keys=None, default_sort="id"):
+        args = request.args if request else {}
+        self._request = request
+        self._id_column = id_column
+        sort_keys = {"id": id_column, **(sort_keys or {})}
+        self.sort = args.get("sort", default_sort)
+        if self.sort not in sort_keys:
+            raise InvalidRequestException
+        if self.sort == "id":
+            self._columns = [id_column]
+        else:
+            self._columns = [sort_keys[self.sort], id_column]
+        try:
+            self.limit = min(int(args.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+        except ValueError:
+            raise InvalidRequestException
+        if self.limit <= 0:
+            raise InvalidRequestException
+        after = args.get("after")
+        self._after = decode_cursor(after, self._columns) if after else None
+
+    def apply(self, query):
+        """Restricts the query to the rows of this page, plus one to tell if there are more."""
+        if self._after:
+            if len(self._columns) == 1:
+                query = query.filter(self._id_column > self._after[0])
+            else:
+                sort_column = self._columns[0]
+                sort_value, last_id = self._after
+                query = query.filter(or_(
+                    sort_column > sort_value,
+                    and_(sort_column == sort_value, self._id_column > last_id)
+                ))
+        return query.order_by(*self._columns).limit(self.limit + 1)
+
+    def rows(self, query):
+        """Returns the rows of this page and the cursor of the next page, or None on the last page."""
+        rows = query.all()
+        if len(rows) <= self.limit:
+            return rows, None
+        rows = rows[:self.limit]
+        last = rows[-1]
+        return rows, encode_cursor([getattr(last, column.key) for column in self._columns])
+
+    def fetch(self, query):
+        return self.rows(self.apply(query))
+
+    def add_next_link(self, response, cursor):
+        """Adds a "next" link to the response body when there is another page."""
+        if cursor:
+            args = {key: value for key, value in self._request.args.items() if key != "after"}
+            args["after"] = cursor
+            response["next"] = f"{self._request.path}?{urlencode(args)}"
+        return response
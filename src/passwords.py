@@ -0,0 +1,81 @@
+"""
+Password hashing on a dedicated, bounded pool of threads.
+
+PBKDF2 is deliberately slow and CPU heavy, so a burst of logins hashing on the request
+threads would starve every other endpoint. Hashes run on HASH_WORKERS threads instead
+(hashlib releases the GIL while it hashes), with at most HASH_QUEUE_LIMIT more waiting.
+When the pool is full further logins are turned away straight away with
+ServiceUnavailableException rather than queueing behind the storm.
+
+The hash is set by PASSWORD_HASH_METHOD and PASSWORD_HASH_ITERATIONS. Stored hashes made
+with other settings still verify, and are replaced with a hash using the current settings
+the next time the user logs in.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import metrics
+from exceptions import ServiceUnavailableException
+
+HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256")
+HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", 150000))
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", 16))
+
+
+def hash_method():
+    """werkzeug's method string for the configured settings, e.g. pbkdf2:sha256:150000."""
+    if HASH_METHOD.startswith("pbkdf2:"):
+        return f"{HASH_METHOD}:{HASH_ITERATIONS}"
+    return HASH_METHOD
+
+
+class HashPool:
+    def __init__(self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self, func, *args):
+        """Runs func on the pool and returns its result. Raises if the pool is saturated."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServiceUnavailableException
+        with self._lock:
+            self.in_flight += 1
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+            self._slots.release()
+
+    def status(self):
+        return {"workers": self.workers, "in_flight": self.in_flight,
+                "completed": self.completed, "rejected": self.rejected}
+
+
+pool = HashPool()
+metrics.register("password_hashing", lambda: pool.status())
+
+
+def hash_password(password):
+    return pool.run(generate_password_hash, password, hash_method())
+
+
+def check_password(hashed_password, password):
+    return pool.run(check_password_hash, hashed_password, password)
+
+
+def needs_rehash(hashed_password):
+    """True if the stored hash wasn't made with the current method and iteration count."""
+    return hashed_password.split("$", 1)[0] != hash_method()
@@ -0,0 +1,194 @@
+"""
+Cache of GET /events and GET /events/<id> responses, in front of the database.
+
+Entries are the response body along with its ETag, so a hit needs no database session at
+all, for a 200 as well as a 304. Writes invalidate what they change once their transaction
+commits, by bumping a generation that is part of the keys: the listing generation for
+changes to any event shown in the listings, and the event's own for changes to one event,
+such as ticket sales. A read that raced with a write stores its result under the old
+generation, where nothing will look it up again.
+
+The backend is set by these environment variables:
+
+READ_CACHE_URL     redis:// URL of a store shared by every worker process. Unset, each
+                   process keeps its own entries and sees other processes' writes only once
+                   its entries expire.
+READ_CACHE_TTL     Seconds an entry is kept (default 10). 0 turns the cache off.
+READ_CACHE_SIZE    Entries kept by the in-process backend (default 1000).
+"""
+import json
+import os
+import threading
+import traceback
+
+from cachetools import TTLCache
+from sqlalchemy import event
+
+import metrics
+from etags import query_digest
+
+READ_CACHE_TTL = int(os.environ.get("READ_CACHE_TTL", 10))
+READ_CACHE_SIZE = int(os.environ.get("READ_CACHE_SIZE", 1000))
+LISTING_GENERATION = "events:generation"
+
+
+class _CountingTTLCache(TTLCache):
+    """Counts the entries dropped to make room for new ones, as opposed to expired ones."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.evictions = 0
+
+    def popitem(self):
+        self.evictions += 1
+        return super().popitem()
+
+
+class LocalBackend:
+    """Bounded TTL/LRU cache in this process."""
+
+    def __init__(self, ttl=READ_CACHE_TTL, size=READ_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._entries = _CountingTTLCache(maxsize=size, ttl=ttl)
+        self._generations = {}  # Never evicted, a reset generation could bring back a stale entry
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    @property
+    def evictions(self):
+        return self._entries.evictions
+
+
+class RedisBackend:
+    """
+    Store shared by every worker, through a client with the redis-py API (get, set with ex,
+    incr). Redis does the bounding and eviction, so evictions aren't counted here.
+    """
+
+    def __init__(self, client, ttl=READ_CACHE_TTL):
+        self._client = client
+        self._ttl = ttl
+        self.evictions = None
+
+    def get(self, key):
+        value = self._client.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self._client.set(key, json.dumps(value), ex=self._ttl)
+
+    def generation(self, key):
+        return int(self._client.get(key) or 0)
+
+    def incr(self, key):
+        self._client.incr(key)
+
+
+class ReadCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    def key(self, request, event_id=None):
+        """The key for the request's response at the current generation, None if the backend is down."""
+        if event_id is not None:
+            try:
+                event_id = int(event_id)  # The same key as the invalidations
+            except ValueError:
+                return None
+        generation_key = LISTING_GENERATION if event_id is None else f"event:{event_id}:generation"
+        try:
+            generation = self.backend.generation(generation_key)
+        except Exception:
+            self._count("errors")
+            traceback.print_exc()
+            return None
+        if event_id is None:
+            return f"events:{generation}:{query_digest(request)}"
+        return f"event:{event_id}:{generation}"
+
+    def get(self, key):
+        """Returns the cached (etag, body), or None."""
+        try:
+            entry = self.backend.get(key)
+        except Exception:
+            self._count("errors")
+            traceback.print_exc()
+            entry = None
+        self._count("misses" if entry is None else "hits")
+        return entry
+
+    def put(self, key, etag, body):
+        try:
+            self.backend.set(key, (etag, body))
+        except Exception:
+            self._count("errors")
+            traceback.print_exc()
+
+    def invalidate_after_commit(self, db_session, event_id=None, listing=False):
+        """Invalidates the event, and the listings if they show the change, if the transaction commits."""
+        pending = db_session.info.get("read_cache_invalidations")
+        if pending is None:
+            pending = db_session.info["read_cache_invalidations"] = set()
+            event.listen(db_session, "after_commit", self._invalidate, once=True)
+            event.listen(db_session, "after_rollback", self._forget, once=True)
+        if event_id is not None:
+            pending.add(f"event:{event_id}:generation")
+        if listing:
+            pending.add(LISTING_GENERATION)
+
+    def _invalidate(self, db_session):
+        for generation_key in db_session.info.pop("read_cache_invalidations", ()):
+            self._count("invalidations")
+            try:
+                self.backend.incr(generation_key)
+            except Exception:
+                self._count("errors")
+                traceback.print_exc()
+
+    def _forget(self, db_session):
+        db_session.info.pop("read_cache_invalidations", None)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def status(self):
+        return {"backend": type(self.backend).__name__, "hits": self.hits, "misses": self.misses,
+                "evictions": self.backend.evictions, "invalidations": self.invalidations, "errors": self.errors}
+
+
+def _backend():
+    url = os.environ.get("READ_CACHE_URL")
+    if url:
+        import redis  # Only needed when the cache is shared
+        return RedisBackend(redis.Redis.from_url(url))
+    return LocalBackend()
+
+
+cache = ReadCache(_backend()) if READ_CACHE_TTL > 0 else None
+if cache:
+    metrics.register("read_cache", lambda: cache.status())
@@ -0,0 +1,65 @@
+"""
+Full text search of event titles.
+
+SQLite keeps the titles in an FTS5 index, event_search, that triggers on the event table
+keep in sync on every insert, update and delete, whatever makes them. Postgres has a GIN
+index on the tsvector of the title, which it maintains itself. Both stem English words, so
+"concerts" finds "Concert".
+
+The index is created along with the event table, or by migration for existing databases.
+"""
+from sqlalchemy import text, Float, Integer
+
+_SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS event_search USING fts5("
+    "title, content='event', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS event_search_insert AFTER INSERT ON event BEGIN "
+    "INSERT INTO event_search (rowid, title) VALUES (new.id, new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS event_search_delete AFTER DELETE ON event BEGIN "
+    "INSERT INTO event_search (event_search, rowid, title) VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER IF NOT EXISTS event_search_update AFTER UPDATE OF title ON event BEGIN "
+    "INSERT INTO event_search (event_search, rowid, title) VALUES ('delete', old.id, old.title); "
+    "INSERT INTO event_search (rowid, title) VALUES (new.id, new.title); END",
+]
+_POSTGRES_VECTOR = "to_tsvector('english', coalesce(title, ''))"  # Must match the index to use it
+_POSTGRES_CREATE = [
+    f"CREATE INDEX IF NOT EXISTS ix_event_title_search ON event USING GIN ({_POSTGRES_VECTOR})",
+]
+
+
+def create_index(connection):
+    statements = _SQLITE_CREATE if connection.dialect.name == "sqlite" else _POSTGRES_CREATE
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def rebuild_index(connection):
+    """Indexes the titles already in the event table."""
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("INSERT INTO event_search (event_search) VALUES ('rebuild')"))
+
+
+def drop_index(connection):
+    """The triggers and the Postgres index go with the event table, the FTS5 table doesn't."""
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS event_search"))
+
+
+def _fts5_query(terms):
+    """Every term must match. Quoted, so that terms are never read as FTS5 syntax."""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms.split())
+
+
+def ranked_events(dialect_name, terms):
+    """
+    Subquery of the id and rank of the events whose title matches all the terms. Lower ranks
+    are better matches.
+    """
+    if dialect_name == "sqlite":
+        query = text("SELECT rowid AS id, bm25(event_search) AS rank FROM event_search "
+                     "WHERE event_search MATCH :terms").bindparams(terms=_fts5_query(terms))
+    else:
+        query = text(f"SELECT id, -ts_rank({_POSTGRES_VECTOR}, plainto_tsquery('english', :terms)) AS rank "
+                     f"FROM event WHERE {_POSTGRES_VECTOR} @@ plainto_tsquery('english', :terms)") \
+            .bindparams(terms=terms)
+    return query.columns(id=Integer, rank=Float).alias("ranked")
@@ -0,0 +1,74 @@
+"""
+Response serialization straight from selected columns.
+
+Reads select only the columns a response needs, so rows come back as plain tuples without
+building ORM objects or going through the session's identity map. Each resource has one
+Serializer, built at import, that knows its columns and turns a row into the response dict,
+formatting prices and times on the way.
+"""
+from sqlalchemy import bindparam
+
+from database import Event, ResoldEvent, SoldTicket, Buyer, User
+from streaming import columns_of
+
+
+def format_price(cent_price):
+    return str(cent_price / 100)
+
+
+def format_time(time):
+    return time.isoformat()
+
+
+class Serializer:
+    """
+    Turns rows of the columns of model, less those excluded, into dicts. rename maps column
+    keys to response keys, formats maps response keys to a function applied to non null values.
+    """
+
+    def __init__(self, model, exclude=(), rename=None, formats=None):
+        rename = rename or {}
+        self.columns = [column for column in columns_of(model) if column.key not in exclude]
+        self._keys = tuple(rename.get(column.key, column.key) for column in self.columns)
+        self._formats = tuple((formats or {}).items())
+
+    def query(self, db_session):
+        return db_session.query(*self.columns)
+
+    def __call__(self, row):
+        item = dict(zip(self._keys, row))
+        for key, format_value in self._formats:
+            value = item[key]
+            if value is not None:
+                item[key] = format_value(value)
+        return item
+
+    def batch(self, db_session, rows):
+        """Same signature as stream_json's serialize_batch."""
+        return [self(row) for row in rows]
+
+
+EVENT = Serializer(Event, exclude=("version",), rename={"cent_price": "price"},
+                   formats={"price": format_price, "time": format_time})
+RESELLER = Serializer(ResoldEvent, exclude=("event_id",))
+TICKET = Serializer(SoldTicket)
+BUYER = Serializer(Buyer)
+USER = Serializer(User, exclude=("hashed_password", "token_version"))
+MYSELF = Serializer(User, exclude=("hashed_password", "token_version", "account_verified", "login_fail_count"))
+
+
+def serialize_events(db_session, rows):
+    """Serializes a batch of event rows, fetching the batch's reseller allocations in one query."""
+    resellers = {}
+    resold_events = db_session.query(ResoldEvent.event_id, *RESELLER.columns) \
+        .filter(ResoldEvent.event_id.in_(bindparam("event_ids", expanding=True))) \
+        .params(event_ids=[row.id for row in rows])
+    for resold in resold_events:
+        resellers.setdefault(resold[0], []).append(RESELLER(resold[1:]))
+    events = []
+    for row in rows:
+        event = EVENT(row)
+        if row.id in resellers:  # Left out for events without resellers
+            event["resellers"] = resellers[row.id]
+        events.append(event)
+    return events
@@ -0,0 +1,63 @@
+"""
+Streaming JSON responses for full exports of a collection.
+
+The rows are read in batches through a server side cursor and written out as they are
+serialized, so memory use stays flat no matter how many rows are exported. The response
+has the same {"<key>": [...]} shape as a single page of the collection.
+"""
+import json
+
+from flask import Response, stream_with_context
+
+from database import DBSession
+
+BATCH_SIZE = 500  # Also bounds IN (...) lists built per batch, which SQLite limits to 999 values
+
+
+def wants_stream(request):
+    return request is not None and request.args.get("stream", "").lower() == "true"
+
+
+def columns_of(model):
+    """Selecting columns rather than the entity skips the ORM identity map entirely."""
+    return [column for column in model.__table__.columns]
+
+
+def stream_json(key, build_query, serialize_batch=None):
+    """
+    build_query(db_session) returns the query to export and serialize_batch(db_session, rows)
+    turns a batch of rows into a list of dicts; by default each row is output as is.
+    The generator opens its own session because the request's session is closed as soon
+    as the view returns, before the body is sent.
+    """
+    if serialize_batch is None:
+        serialize_batch = _rows_as_dicts
+
+    def generate():
+        db_session = DBSession()
+        try:
+            query = build_query(db_session).execution_options(stream_results=True).yield_per(BATCH_SIZE)
+            yield f'{{"{key}": ['
+            separator = ""
+            batch = []
+            for row in query:
+                batch.append(row)
+                if len(batch) == BATCH_SIZE:
+                    yield separator + _encode(serialize_batch(db_session, batch))
+                    separator = ","
+                    batch = []
+            if batch:
+                yield separator + _encode(serialize_batch(db_session, batch))
+            yield "]}"
+        finally:
+            db_session.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def _rows_as_dicts(db_session, rows):
+    return [row._asdict() for row in rows]
+
+
+def _encode(items):
+    return ",".join(json.dumps(item) for item in items)
@@ -1,11 +1,21 @@
 from flask_testing import TestCase
+import datetime
 import app
-import emails
+import outbox
 import google_auth
-from users import Role
+import github_auth
+from users import Role, token_versions, foreign_users, login_throttle, IdentityStats
+import users
 import os
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+from werkzeug.security import generate_password_hash
 import database
+import inventory
+import passwords
+import read_cache
+from events import event_filters
+from serializers import EVENT
+import sqlalchemy
 
 
 class TestTicketManagerApi(TestCase):
@@ -52,6 +62,124 @@ class TestTicketManagerApi(TestCase):
             else:
                 self.sell_ticket(event["id"], TestUsers.res_1["id"])
 
+    def test_sell_out_is_per_event(self):
+        first = self.create_event()
+        second = self.create_event()
+        for i in range(first["number_of_tickets"]):
+            self.sell_ticket(first["id"], TestUsers.org_1["id"])
+        self.sell_ticket(first["id"], TestUsers.org_1["id"], expect_failure="Event sold out.")
+        self.sell_ticket(second["id"], TestUsers.org_1["id"])
+
+    def test_removing_ticket_frees_a_place(self):
+        event = self.create_event()
+        for i in range(event["number_of_tickets"]):
+            self.sell_ticket(event["id"], TestUsers.org_1["id"])
+        self.sell_ticket(event["id"], TestUsers.org_1["id"], expect_failure="Event sold out.")
+        body, code = self.delete("/sold-tickets/1", TestUsers.admin)
+        self.assertEqual(200, code)
+        self.sell_ticket(event["id"], TestUsers.org_1["id"])
+
+    def test_reconcile_inventory(self):
+        event = self.add_reseller(self.create_event()["id"], 3)
+        self.sell_ticket(event["id"], TestUsers.org_1["id"])
+        self.sell_ticket(event["id"], TestUsers.res_1["id"])
+        self.sell_ticket(event["id"], TestUsers.res_1["id"])
+
+        expected = [(TestUsers.org_1["id"], 7, 1), (TestUsers.res_1["id"], 3, 2)]
+        self.assertEqual(expected, self.inventory_counters())
+        database.engine.execute(database.Inventory.__table__.update().values(sold=0))
+        with database.engine.begin() as connection:
+            inventory.rebuild_counters(connection)
+        self.assertEqual(expected, self.inventory_counters())
+
+    def test_organizer_sells_from_own_allocation(self):
+        """An organizer holding a reseller allocation on someone else's event sells and refunds from it."""
+        body, code = self.post("/events", TestUsers.admin, {
+            "title": "Admin's concert", "price": "10", "currency_code": "GBP",
+            "time": f"{in_days(1)}T20:00:00Z", "number_of_tickets": 7})
+        event_id = body["event"]["id"]
+        body, code = self.put(f"/events/{event_id}", TestUsers.admin,
+                              {"resellers": [{"seller_id": TestUsers.org_1["id"], "number_of_tickets": 4}]})
+        self.assertEqual(200, code, body)
+
+        self.sell_ticket(event_id, TestUsers.org_1["id"])
+        self.assertEqual([(TestUsers.admin["id"], 3, 0), (TestUsers.org_1["id"], 4, 1)], self.inventory_counters())
+        with database.engine.begin() as connection:
+            inventory.rebuild_counters(connection)
+        self.assertEqual([(TestUsers.admin["id"], 3, 0), (TestUsers.org_1["id"], 4, 1)], self.inventory_counters())
+        self.assertEqual(200, self.delete("/sold-tickets/1", TestUsers.admin)[1])
+        self.assertEqual([(TestUsers.admin["id"], 3, 0), (TestUsers.org_1["id"], 4, 0)], self.inventory_counters())
+        for i in range(4):
+            self.sell_ticket(event_id, TestUsers.org_1["id"])
+        self.sell_ticket(event_id, TestUsers.org_1["id"], expect_failure="Event sold out.")
+
+    def test_bulk_sale(self):
+        event = self.add_reseller(self.create_event()["id"], 2)
+        buyers = [{"name": f"Buyer {i}", "phone": "+441234567890", "email": f"buyer{i}@email.com"} for i in range(6)]
+        with QueryCounter(database.engine) as queries:
+            body, code = self.post("/sold-tickets/bulk", TestUsers.org_1,
+                                   {"event_id": event["id"], "seller_id": TestUsers.org_1["id"], "buyers": buyers})
+        self.assertEqual(200, code, body)
+        inserts = [statement.split("(")[0].strip() for statement in queries.statements
+                   if statement.startswith("INSERT")]
+        self.assertEqual(["INSERT INTO buyer", "INSERT INTO sold_ticket"], inserts)  # One executemany each
+        self.assertEqual([1, 2, 3, 4, 5, 6], [ticket["id"] for ticket in body["tickets"]])
+        self.assertEqual([1, 2, 3, 4, 5, 6], [ticket["buyer_id"] for ticket in body["tickets"]])
+
+        # Only two of the organizer's eight tickets are left, so nothing from this booking is sold
+        body, code = self.post("/sold-tickets/bulk", TestUsers.org_1,
+                               {"event_id": event["id"], "seller_id": TestUsers.org_1["id"], "buyers": buyers[:3]})
+        self.assertEqual({"error": "Event sold out."}, body)
+        body, code = self.get("/buyers", TestUsers.admin)
+        self.assertEqual(6, len(body["buyers"]))
+
+        invalid = buyers[:1] + [{"name": "Bad", "phone": "123", "email": "bad@email.com"}]
+        body, code = self.post("/sold-tickets/bulk", TestUsers.org_1,
+                               {"event_id": event["id"], "seller_id": TestUsers.org_1["id"], "buyers": invalid})
+        self.assertEqual(400, code)
+        body, code = self.post("/sold-tickets/bulk", TestUsers.org_1,
+                               {"event_id": event["id"], "seller_id": TestUsers.org_1["id"], "buyers": buyers[:2]})
+        self.assertEqual(200, code)
+        self.sell_ticket(event["id"], TestUsers.org_1["id"], expect_failure="Event sold out.")
+
+    def test_import_events(self):
+        csv_body = "\n".join([
+            "title,price,currency_code,time,number_of_tickets,resellers",
+            f'Opening night,25.50,GBP,{in_days(1)}T19:30:00,100,"[{{""seller_id"": 3, ""number_of_tickets"": 20}}]"',
+            f"Matinee,abc,GBP,{in_days(2)}T14:00:00,50,",
+            f"Closing night,30,GBP,{in_days(3)}T19:30:00,100,",
+            f'Gala,30,GBP,{in_days(4)}T19:30:00,10,"[{{""seller_id"": 99, ""number_of_tickets"": 5}}]"',
+        ])
+        token, access_type = self.login(TestUsers.org_1)
+        response = self.client.post("/events/import", data=csv_body, content_type="text/csv", headers={
+            "access-token": token, "access-type": access_type})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"imported": 2, "failed": 2, "errors": [
+            {"row": 2, "error": "price must be a decimal number"},
+            {"row": 4, "error": "unknown user 99"},
+        ]}, response.json)
+        body, code = self.get("/events")
+        self.assertEqual(["Opening night", "Closing night"], [event["title"] for event in body["events"]])
+        self.assertEqual("25.5", body["events"][0]["price"])
+        self.assertEqual(TestUsers.org_1["id"], body["events"][0]["organizer_id"])
+        self.assertEqual([{"seller_id": 3, "number_of_tickets": 20}], body["events"][0]["resellers"])
+        self.sell_ticket(body["events"][0]["id"], TestUsers.res_1["id"])
+
+        jsonl_body = "\n".join([
+            f'{{"title": "Late show", "price": "10", "currency_code": "GBP", "time": "{in_days(5)}T22:00:00",'
+            ' "number_of_tickets": 5}',
+            "not json",
+        ])
+        response = self.client.post("/events/import?format=jsonl", data=jsonl_body, headers={
+            "access-token": token, "access-type": access_type})
+        self.assertEqual({"imported": 1, "failed": 1, "errors": [{"row": 2, "error": "row is not valid JSON"}]},
+                         response.json)
+
+        token, access_type = self.login(TestUsers.res_1)
+        response = self.client.post("/events/import", data=csv_body, content_type="text/csv", headers={
+            "access-token": token, "access-type": access_type})
+        self.assertEqual(403, response.status_code)
+
     def test_block_user(self):
         for i in range(4):
             response = self.client.post("/login", json={
@@ -87,7 +215,7 @@ class TestTicketManagerApi(TestCase):
             "title": "New music concert",
             "price": "63.72",
             "currency_code": "GBP",
-            "time": "2021-03-29T00:00:00",
+            "time": f"{in_days(0)}T00:00:00",
             "number_of_tickets": 20
         }
         self.update_event(event_changes, event["id"])
@@ -137,6 +265,457 @@ class TestTicketManagerApi(TestCase):
         self.assertEqual(200, code)
         self.assertEqual({"buyers": []}, body)
 
+    def test_event_listing_query_count(self):
+        """Listing events must cost the same number of queries however many events there are."""
+        self.add_reseller(self.create_event()["id"], 2)
+        with QueryCounter(database.engine) as one_event:
+            body, code = self.get("/events")
+        self.assertEqual(200, code)
+        self.assertEqual(1, len(body["events"]))
+        for _ in range(4):
+            self.add_reseller(self.create_event()["id"], 2)
+        with QueryCounter(database.engine) as five_events:
+            body, code = self.get("/events")
+        self.assertEqual(200, code)
+        self.assertEqual(5, len(body["events"]))
+        self.assertEqual([{"seller_id": TestUsers.res_1["id"], "number_of_tickets": 2}], body["events"][4]["resellers"])
+        self.assertEqual(one_event.count, five_events.count)
+
+        event = self.create_event()
+        self.assertNotIn("resellers", event)
+        self.assertNotIn("resellers", self.get(f"/events/{event['id']}")[0]["event"])
+        for url in ["/events", "/events?stream=true"]:
+            self.assertNotIn("resellers", self.get(url)[0]["events"][5], url)
+
+    def test_reads_load_no_orm_objects(self):
+        event = self.add_reseller(self.create_event()["id"], 2)
+        self.sell_ticket(event["id"], TestUsers.org_1["id"])
+        loaded = []
+
+        def on_load(target, context):
+            if not isinstance(target, database.User):  # Logging in loads the user
+                loaded.append(target)
+        sqlalchemy.event.listen(database.Base, "load", on_load, propagate=True)
+        self.addCleanup(sqlalchemy.event.remove, database.Base, "load", on_load)
+        for url, user in [("/events", None), (f"/events/{event['id']}", None), ("/sold-tickets", None),
+                          ("/sold-tickets/1", None), ("/buyers", TestUsers.admin)]:
+            body, code = self.get(url, user)
+            self.assertEqual(200, code, url)
+        self.assertEqual([], loaded)
+
+    def test_conditional_get_of_events(self):
+        event = self.create_event()
+        for url in ["/events", f"/events/{event['id']}", "/events?limit=1"]:
+            etag = self.client.get(url).headers["ETag"]
+            with QueryCounter(database.engine) as queries, patch.object(read_cache, "cache", None):
+                response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(304, response.status_code, url)
+            self.assertEqual(etag, response.headers["ETag"])
+            self.assertEqual(1, queries.count)  # The version only
+        self.assertNotEqual(self.client.get("/events").headers["ETag"],
+                            self.client.get("/events?limit=1").headers["ETag"])
+        # The version column behind the ETags isn't part of the events
+        self.assertNotIn("version", event)
+        self.assertNotIn("version", self.put(f"/events/{event['id']}", TestUsers.org_1, {"title": "Title"})[0]["event"])
+        self.assertNotIn("version", self.get(f"/events/{event['id']}")[0]["event"])
+        for url in ["/events", "/events?stream=true"]:
+            self.assertNotIn("version", self.get(url)[0]["events"][0], url)
+
+        def changes(change):
+            etags = [self.client.get(url).headers["ETag"] for url in ["/events", f"/events/{event['id']}"]]
+            change()
+            return [self.client.get(url, headers={"If-None-Match": etag}).status_code
+                    for url, etag in zip(["/events", f"/events/{event['id']}"], etags)]
+
+        self.assertEqual([200, 200], changes(lambda: self.update_event({"title": "New title"}, event["id"])))
+        self.assertEqual([200, 200], changes(lambda: self.add_reseller(event["id"], 2)))
+        self.assertEqual([304, 200], changes(lambda: self.sell_ticket(event["id"], TestUsers.org_1["id"])))
+        self.assertEqual([304, 200], changes(lambda: self.delete("/sold-tickets/1", TestUsers.admin)))
+        self.assertEqual([200, 304], changes(self.create_event))
+        body, code = self.get("/metrics", TestUsers.admin)
+        self.assertGreater(body["etags"]["hit_rate"], 0)
+
+        etag = self.client.get(f"/events/{event['id']}").headers["ETag"]
+        self.delete(f"/events/{event['id']}", TestUsers.org_1)
+        response = self.client.get(f"/events/{event['id']}", headers={"If-None-Match": etag})
+        self.assertEqual(404, response.status_code)
+        self.assertNotIn("ETag", response.headers)
+
+    def test_event_reads_are_cached(self):
+        event = self.create_event()
+        urls = ["/events", f"/events/{event['id']}"]
+        for url in urls:
+            first = self.client.get(url)
+            with QueryCounter(database.engine) as queries:
+                response = self.client.get(url)
+            self.assertEqual(0, queries.count, url)
+            self.assertEqual(first.json, response.json)
+            self.assertEqual(first.headers["ETag"], response.headers["ETag"])
+            with QueryCounter(database.engine) as queries:
+                response = self.client.get(url, headers={"If-None-Match": first.headers["ETag"]})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(0, queries.count, url)
+
+        def reads_database():
+            counts = []
+            for url in urls:
+                with QueryCounter(database.engine) as queries:
+                    self.client.get(url)
+                counts.append(queries.count > 0)
+            return counts
+
+        self.update_event({"title": "New title"}, event["id"])
+        self.assertEqual([True, True], reads_database())
+        self.assertEqual("New title", self.client.get(urls[1]).json["event"]["title"])
+        self.assertNotIn("version", self.client.get(urls[1]).json["event"])
+        self.add_reseller(event["id"], 2)
+        self.assertEqual([True, True], reads_database())
+        self.sell_ticket(event["id"], TestUsers.org_1["id"])
+        self.assertEqual([False, True], reads_database())  # Listings don't show sales
+        self.update_event({"title": "Not allowed"}, event["id"], "Not authorized.", user=TestUsers.res_1)
+        self.assertEqual([False, False], reads_database())  # Rolled back
+        self.delete("/sold-tickets/1", TestUsers.admin)
+        self.assertEqual([False, True], reads_database())
+        self.delete(f"/events/{event['id']}", TestUsers.org_1)
+        self.assertEqual({"events": []}, self.client.get(urls[0]).json)
+        self.assertEqual(404, self.client.get(urls[1]).status_code)
+
+        body, code = self.get("/metrics", TestUsers.admin)
+        self.assertEqual("LocalBackend", body["read_cache"]["backend"])
+        self.assertGreater(body["read_cache"]["hits"], 0)
+        self.assertGreater(body["read_cache"]["invalidations"], 0)
+
+    def test_remove_event_with_resellers(self):
+        event = self.add_reseller(self.create_event()["id"], 2)
+        body, code = self.delete(f"/events/{event['id']}", user=TestUsers.org_1)
+        self.assertEqual(200, code)
+        self.assertEqual(0, database.get_db_session().query(database.ResoldEvent).count())
+
+    def test_event_pagination(self):
+        for day in [5, 3, 4, 1, 2]:
+            event = {
+                "title": f"Concert {day}",
+                "price": "10",
+                "currency_code": "GBP",
+                "time": f"{in_days(day)}T20:00:00",
+                "number_of_tickets": 10,
+            }
+            body, code = self.post("/events", TestUsers.org_1, event)
+            self.assertEqual(200, code)
+        titles = []
+        url = "/events?limit=2&sort=time"
+        while url:
+            body, code = self.get(url)
+            self.assertEqual(200, code)
+            self.assertLessEqual(len(body["events"]), 2)
+            titles += [event["title"] for event in body["events"]]
+            url = body.get("next")
+        self.assertEqual([f"Concert {day}" for day in range(1, 6)], titles)
+
+        body, code = self.get("/events?limit=3")
+        self.assertEqual([1, 2, 3], [event["id"] for event in body["events"]])
+        body, code = self.get(body["next"])
+        self.assertEqual([4, 5], [event["id"] for event in body["events"]])
+        self.assertNotIn("next", body)
+
+        body, code = self.get("/events?after=not-a-cursor")
+        self.assertEqual(400, code)
+        body, code = self.get("/events?sort=title")
+        self.assertEqual(400, code)
+
+    def test_event_filters(self):
+        for day, currency_code, price, tickets in [(1, "GBP", "10", 1), (2, "USD", "20", 2), (3, "GBP", "30", 3)]:
+            body, code = self.post("/events", TestUsers.org_1, {
+                "title": f"Concert {day}", "price": price, "currency_code": currency_code,
+                "time": f"{in_days(day)}T20:00:00Z", "number_of_tickets": tickets})
+            self.assertEqual(200, code)
+        body, code = self.post("/events", TestUsers.admin, {
+            "title": "Admin's concert", "price": "10", "currency_code": "GBP",
+            "time": f"{in_days(4)}T20:00:00Z", "number_of_tickets": 1})
+        self.sell_ticket(1, TestUsers.org_1["id"])
+
+        def titles(query):
+            body, code = self.get(f"/events?sort=time&{query}")
+            self.assertEqual(200, code, query)
+            return [event["title"] for event in body["events"]]
+
+        self.assertEqual(["Concert 2", "Concert 3"], titles(f"from={in_days(2)}T20:00:00Z&to={in_days(4)}T00:00:00Z"))
+        self.assertEqual(["Concert 2"], titles(f"from={in_days(2)}T21:00:00%2B01:00&to={in_days(3)}T00:00:00Z"))
+        self.assertEqual(["Concert 1", "Concert 2", "Concert 3"], titles(f"organizer_id={TestUsers.org_1['id']}"))
+        self.assertEqual(["Concert 1", "Concert 3", "Admin's concert"], titles("currency_code=GBP"))
+        self.assertEqual(["Concert 2", "Concert 3"], titles("min_price=15"))
+        self.assertEqual(["Concert 1", "Concert 2", "Admin's concert"], titles("max_price=20.00"))
+        self.assertEqual(["Concert 2", "Concert 3", "Admin's concert"], titles("available=true"))
+        self.assertEqual(["Concert 1"], titles("available=false"))
+        self.assertEqual(["Concert 3"],
+                         titles(f"organizer_id={TestUsers.org_1['id']}&currency_code=GBP&available=true"))
+        body, code = self.get("/events?stream=true&currency_code=USD")
+        self.assertEqual(["Concert 2"], [event["title"] for event in body["events"]])
+
+        self.assertEqual(["Concert 2", "Concert 3", "Admin's concert"], titles("available=true"))  # Cached
+        self.assertEqual(200, self.delete("/sold-tickets/1", TestUsers.admin)[1])
+        self.assertEqual(["Concert 1", "Concert 2", "Concert 3", "Admin's concert"], titles("available=true"))
+        self.sell_ticket(1, TestUsers.org_1["id"])
+        self.assertEqual(["Concert 2", "Concert 3", "Admin's concert"], titles("available=true"))
+
+        for query in ["from=yesterday", "organizer_id=me", "min_price=cheap", "available=maybe"]:
+            body, code = self.get(f"/events?{query}")
+            self.assertEqual(400, code, query)
+
+    def test_event_times_are_stored_in_utc(self):
+        body, code = self.post("/events", TestUsers.org_1, {
+            "title": "Concert", "price": "10", "currency_code": "GBP",
+            "time": f"{in_days(1)}T10:00:00+02:00", "number_of_tickets": 1})
+        self.assertEqual(f"{in_days(1)}T08:00:00", body["event"]["time"])
+        body, code = self.put(f"/events/{body['event']['id']}", TestUsers.org_1,
+                              {"time": f"{in_days(1)}T09:00:00+01:00"})
+        self.assertEqual(f"{in_days(1)}T08:00:00", body["event"]["time"])
+
+        def titles(query):
+            body, code = self.get(f"/events?{query}")
+            self.assertEqual(200, code, query)
+            return [event["title"] for event in body["events"]]
+
+        self.assertEqual(["Concert"], titles(f"to={in_days(1)}T11:00:00%2B02:00"))
+        self.assertEqual([], titles(f"from={in_days(1)}T10:30:00%2B02:00"))
+        self.assertEqual(["Concert"], titles(f"from={in_days(1)}T08:00:00Z&to={in_days(1)}T08:00:01Z"))
+
+    def test_event_filters_use_indexes(self):
+        db_session = database.get_db_session()
+        for args, index in [({"organizer_id": "2"}, "ix_event_organizer_id_time"),
+                            ({"currency_code": "GBP"}, "ix_event_currency_code_time"),
+                            ({"from": f"{in_days(1)}T00:00:00Z"}, "ix_event_time")]:
+            query = EVENT.query(db_session).filter(*event_filters(args)).order_by(database.Event.time)
+            sql = str(query.statement.compile(database.engine, compile_kwargs={"literal_binds": True}))
+            plan = " ".join(str(row) for row in db_session.execute("EXPLAIN QUERY PLAN " + sql))
+            self.assertIn(index, plan, args)
+        db_session.close()
+
+    def test_event_search(self):
+        for title in ["Jazz concert", "Rock festival", "Rock concert", "Rock, rock and more rock concerts"]:
+            body, code = self.post("/events", TestUsers.org_1, {
+                "title": title, "price": "10", "currency_code": "GBP",
+                "time": f"{in_days(1)}T20:00:00Z", "number_of_tickets": 10})
+            self.assertEqual(200, code)
+
+        def titles(url):
+            body, code = self.get(url)
+            self.assertEqual(200, code, url)
+            return [event["title"] for event in body["events"]], body.get("next")
+
+        self.assertEqual((["Rock concert", "Rock, rock and more rock concerts"], None),
+                         titles("/events/search?q=rock+Concerts"))
+        found, url = titles("/events/search?q=rock&limit=2")
+        while url:
+            more, url = titles(url)
+            found += more
+        self.assertEqual(["Rock, rock and more rock concerts", "Rock festival", "Rock concert"], found)
+        self.assertEqual((["Jazz concert"], None), titles("/events/search?q=jazz&currency_code=GBP"))
+        self.assertEqual(([], None), titles("/events/search?q=jazz&currency_code=USD"))
+        self.assertEqual(([], None), titles('/events/search?q="rock" OR NEAR(*'))
+
+        self.update_event({"title": "Blues concert"}, 1)
+        self.assertEqual(([], None), titles("/events/search?q=jazz"))
+        self.assertEqual((["Blues concert"], None), titles("/events/search?q=blues"))
+        self.assertEqual(200, self.delete("/events/1", TestUsers.org_1)[1])
+        self.assertEqual(([], None), titles("/events/search?q=blues"))
+
+        body, code = self.get("/events/search?q=")
+        self.assertEqual(400, code)
+
+    def test_availability(self):
+        event = self.add_reseller(self.create_event()["id"], 2)
+        other_event = self.create_event()
+        self.sell_ticket(event["id"], TestUsers.org_1["id"])
+        self.sell_ticket(event["id"], TestUsers.res_1["id"])
+
+        body, code = self.get(f"/events/{event['id']}/availability")
+        self.assertEqual(200, code)
+        self.assertEqual({"event_id": event["id"], "remaining": 8, "sellers": [
+            {"seller_id": TestUsers.org_1["id"], "allocated": 8, "sold": 1, "remaining": 7},
+            {"seller_id": TestUsers.res_1["id"], "allocated": 2, "sold": 1, "remaining": 1},
+        ]}, body)
+        body, code = self.get(f"/events/{event['id']}/availability?seller_id={TestUsers.res_1['id']}")
+        self.assertEqual((1, [TestUsers.res_1["id"]]), (body["remaining"], [s["seller_id"] for s in body["sellers"]]))
+
+        with QueryCounter(database.engine) as queries:
+            body, code = self.get(f"/events/availability?event_ids={other_event['id']},{event['id']},99")
+        self.assertEqual(200, code)
+        self.assertEqual([(other_event["id"], 10), (event["id"], 8)],
+                         [(entry["event_id"], entry["remaining"]) for entry in body["availability"]])
+        self.assertEqual(1, queries.count)
+
+        etag = self.client.get(f"/events/{event['id']}/availability").headers["ETag"]
+        self.assertEqual(304, self.client.get(f"/events/{event['id']}/availability",
+                                              headers={"If-None-Match": etag}).status_code)
+        self.sell_ticket(event["id"], TestUsers.org_1["id"])
+        response = self.client.get(f"/events/{event['id']}/availability", headers={"If-None-Match": etag})
+        self.assertEqual((200, 7), (response.status_code, response.json["remaining"]))
+
+        self.assertEqual(404, self.get("/events/99/availability")[1])
+        with QueryCounter(database.engine) as queries:  # Postgres would fail comparing "abc" with the id
+            self.assertEqual(404, self.get("/events/abc/availability")[1])
+        self.assertEqual(0, queries.count)
+        self.assertEqual(400, self.get("/events/availability?event_ids=1,two")[1])
+        self.assertEqual(400, self.get("/events/availability?event_ids=" + ",".join(["1"] * 501))[1])
+
+    def test_user_pagination(self):
+        body, code = self.get("/users?limit=2", TestUsers.admin)
+        self.assertEqual(200, code)
+        self.assertEqual([1, 2], [user["id"] for user in body["users"]])
+        body, code = self.get(body["next"], TestUsers.admin)
+        self.assertEqual([3], [user["id"] for user in body["users"]])
+        self.assertNotIn("next", body)
+
+    def test_streamed_exports_match_pages(self):
+        self.add_reseller(self.create_event()["id"], 2)
+        self.create_event()
+        for _ in range(3):
+            self.sell_ticket(1, TestUsers.org_1["id"])
+        for url, user in [("/events", None), ("/sold-tickets", None), ("/buyers", TestUsers.admin),
+                          ("/users", TestUsers.admin)]:
+            page, code = self.get(url, user)
+            self.assertEqual(200, code)
+            streamed, code = self.get(f"{url}?stream=true", user)
+            self.assertEqual(200, code)
+            self.assertEqual(page, streamed)
+        body, code = self.get("/buyers?stream=true", TestUsers.org_1)
+        self.assertEqual(403, code)
+
+    def test_metrics(self):
+        body, code = self.get("/metrics", TestUsers.org_1)
+        self.assertEqual(403, code)
+        body, code = self.get("/metrics", TestUsers.admin)
+        self.assertEqual(200, code)
+        self.assertEqual("StaticPool", body["db_pool"]["pool"])
+        self.assertGreater(body["db_pool"]["checkouts"], 0)
+
+    def test_token_needs_no_user_lookup(self):
+        token, access_type = self.login(TestUsers.org_1)
+        headers = {"access-token": token, "access-type": access_type}
+        self.client.get("/metrics", headers=headers)
+        with QueryCounter(database.engine) as queries:
+            response = self.client.get("/metrics", headers=headers)
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(0, queries.count)
+
+    def test_returning_oauth_user_needs_no_queries(self):
+        headers = {"access-token": "i am a google token", "access-type": "google"}
+        self.assertEqual(403, self.client.get("/metrics", headers=headers).status_code)
+        with QueryCounter(database.engine) as queries:
+            response = self.client.get("/metrics", headers=headers)
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(0, queries.count)
+        self.assertEqual(1, database.get_db_session().query(database.User).filter_by(foreign_user_id="123").count())
+
+    def test_rolled_back_oauth_user_is_not_cached(self):
+        """The first request of a new OAuth user fails, so the user it inserted is rolled back."""
+        headers = {"access-token": "a new google token", "access-type": "google"}
+        with patch.object(google_auth.id_token, "verify_oauth2_token", MagicMock(return_value={"sub": "g-1"})):
+            self.assertEqual(403, self.client.get("/users", headers=headers).status_code)
+            body, code = self.post("/register", data={"name": "victim", "email": "victim@localmail.com",
+                                                      "password": "password4"})
+            self.assertEqual(200, code, body)
+            response = self.client.get("/myself", headers=headers)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("g-1", response.json["foreign_user_id"])
+        self.assertIsNone(response.json["email"])
+
+    def test_password_is_rehashed_on_login(self):
+        db_session = database.get_db_session()
+        user = db_session.query(database.User).filter_by(email=TestUsers.org_1["email"]).one()
+        user.hashed_password = generate_password_hash(TestUsers.org_1["password"], "pbkdf2:sha256:1000")
+        db_session.commit()
+        self.login(TestUsers.org_1)
+        db_session.expire_all()
+        self.assertFalse(passwords.needs_rehash(user.hashed_password))
+        self.assertTrue(passwords.check_password(user.hashed_password, TestUsers.org_1["password"]))
+        db_session.close()
+
+    def test_login_is_shed_when_hashing_is_saturated(self):
+        with patch.object(passwords, "pool", passwords.HashPool(workers=1, queue_limit=0)):
+            passwords.pool._slots.acquire()
+            response = self.client.post("/login", json={
+                "email": TestUsers.org_1["email"], "password": TestUsers.org_1["password"]})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual("1", response.headers["Retry-After"])
+
+    def test_sale_is_unavailable_while_github_is_down(self):
+        event = self.create_event()
+        with patch.object(github_auth.breaker, "allow", return_value=False):
+            response = self.client.post("/sold-tickets", headers={
+                "access-token": "a github token", "access-type": "github"}, json={
+                "event_id": event["id"],
+                "buyer": {"name": "Joe Blogs", "phone": "+441234567890", "email": "joe@email.com"}})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual("1", response.headers["Retry-After"])
+
+    def test_blocked_account_is_throttled(self):
+        for _ in range(3):
+            response = self.client.post("/login", json={"email": TestUsers.org_1["email"], "password": "wrong"})
+            self.assertEqual("Wrong username or password.", response.json["error"])
+        hashes = passwords.pool.completed
+        with QueryCounter(database.engine) as queries:
+            response = self.client.post("/login", json={
+                "email": TestUsers.org_1["email"], "password": TestUsers.org_1["password"]})
+        self.assertEqual("Account blocked.", response.json["error"])
+        self.assertEqual(0, queries.count)
+        self.assertEqual(hashes, passwords.pool.completed)
+
+    def test_tokens_are_revoked(self):
+        token, access_type = self.login(TestUsers.org_1)
+        headers = {"access-token": token, "access-type": access_type}
+        self.assertEqual(200, self.client.get("/myself", headers=headers).status_code)
+        body, code = self.put(f"/users/{TestUsers.org_1['id']}", TestUsers.org_1, {"password": "new_password"})
+        self.assertEqual(200, code)
+        response = self.client.get("/myself", headers=headers)
+        self.assertEqual(401, response.status_code)
+        self.assertEqual("Token invalid.", response.json["error"])
+
+        token = self.client.post("/login", json={
+            "email": TestUsers.org_1["email"], "password": "new_password"}).json["auth_token"]
+        headers = {"access-token": token, "access-type": access_type}
+        self.assertEqual(200, self.client.get("/myself", headers=headers).status_code)
+        body, code = self.put(f"/users/{TestUsers.org_1['id']}", TestUsers.admin, {"block": True})
+        self.assertEqual(200, code)
+        self.assertEqual(401, self.client.get("/myself", headers=headers).status_code)
+
+    def test_revoked_token_version_is_forgotten_on_commit(self):
+        """A request that caches the old version while the revoking transaction is open can't keep it."""
+        user_id = TestUsers.org_1["id"]
+        with app.UsersContext(None) as users_in_transaction:
+            users_in_transaction.storage.revoke_tokens(user_id)
+            self.assertEqual(0, token_versions.get(user_id, lambda user_id: 0))  # Read by another request
+        self.assertEqual(1, token_versions.get(user_id, lambda user_id: 1))
+
+        with self.assertRaises(RuntimeError):
+            with app.UsersContext(None) as users_in_transaction:
+                users_in_transaction.storage.revoke_tokens(user_id)
+                raise RuntimeError
+        self.assertEqual(1, token_versions.get(user_id, lambda user_id: 2))
+
+    def test_identity_is_resolved_once_per_request(self):
+        event = self.create_event()
+        with patch.object(users, "identity_stats", IdentityStats()) as stats:
+            self.add_reseller(event["id"], 2)
+            body, code = self.post("/sold-tickets", TestUsers.res_1, {
+                "event_id": event["id"],
+                "buyer": {"name": "Joe Blogs", "phone": "+441234567890", "email": "joe@email.com"}})
+            self.assertEqual(200, code)
+            self.assertEqual(200, self.delete("/sold-tickets/1", TestUsers.admin)[1])
+            self.assertEqual(200, self.delete("/buyers/1", TestUsers.admin)[1])
+            self.assertEqual(200, self.put(f"/users/{TestUsers.org_1['id']}", TestUsers.org_1, {"name": "Org"})[1])
+            self.assertEqual(200, self.put(f"/users/{TestUsers.org_1['id']}", TestUsers.org_1,
+                                           {"password": TestUsers.org_1["password"]})[1])
+        self.assertEqual(1, stats.max_per_request)
+        self.assertEqual(6, stats.resolutions)  # Logins resolve none
+
+    @staticmethod
+    def inventory_counters():
+        """(seller_id, allocated, sold) of every inventory row."""
+        rows = database.get_db_session().query(database.Inventory).order_by(database.Inventory.seller_id)
+        return [(row.seller_id, row.allocated, row.sold) for row in rows]
+
     def add_reseller(self, event_id, number_of_tickets):
 
         event = {
@@ -156,7 +735,7 @@ class TestTicketManagerApi(TestCase):
             "title": "Music concert",
             "price": "60.70",
             "currency_code": "GBP",
-            "time": "2021-09-29T10:30:06.937Z",
+            "time": f"{in_days(0)}T10:30:06.937Z",
             "number_of_tickets": 10,
             "organizer_id": TestUsers.org_1["id"],
         }
@@ -193,6 +772,10 @@ class TestTicketManagerApi(TestCase):
 
     def setUp(self) -> None:
         database.recreate_db()
+        token_versions.clear()
+        read_cache.cache.backend.clear()
+        foreign_users.clear()
+        login_throttle.clear()
         os.environ["INIT_ADMIN_EMAIL"] = TestUsers.admin["email"]
         os.environ["ADMIN_PASSWORD"] = TestUsers.admin["password"]
         os.environ["SECRET_KEY"] = "SECRET_KEY"
@@ -203,10 +786,11 @@ class TestTicketManagerApi(TestCase):
         with app.UsersContext(None) as users:
             users.create_admin_user()
         smtp_mock = MagicMock()
-        emails.smtplib.SMTP = smtp_mock
         google_auth.id_token.verify_oauth2_token = MagicMock(return_value={"sub": "123"})
         body, code = self.post("/register", data=TestUsers.org_1)
         self.assertEqual(200, code, body.get("error", ""))
+        with patch.object(outbox.smtplib, "SMTP", smtp_mock):
+            outbox.OutboxSender().send_batch()
         activate_url = ""
         for call in smtp_mock.mock_calls:
             if "sendmail" in call[0]:
@@ -281,6 +865,31 @@ class TestTicketManagerApi(TestCase):
         return app.app
 
 
+class QueryCounter:
+    """Counts the SQL statements run against an engine inside a with block."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _count(self, connection, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        sqlalchemy.event.remove(self.engine, "before_cursor_execute", self._count)
+
+
+def in_days(days):
+    """The date a month and days from now, as events can't be in the past."""
+    return (datetime.date.today() + datetime.timedelta(days=30 + days)).isoformat()
+
+
 def without(d, key):
     new_d = d.copy()
     new_d.pop(key)
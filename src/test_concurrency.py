@@ -0,0 +1,174 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+import app
+import database
+import migrations
+import passwords
+from database import Base, User, Event, SoldTicket, Inventory
+from inventory import InventoryStorage
+from users import Role, login_throttle, _Storage as UserStorage
+
+PURCHASES = 2000
+THREADS = 16
+TICKETS = 150
+
+
+class TestConcurrentPurchases(TestCase):
+    """Fires concurrent purchases at one event through the API, against a file backed database
+    so that every thread gets its own connection and transaction."""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = database.create_engine_from_config({
+            "DATABASE_URL": f"sqlite:///{os.path.join(self.directory.name, 'test.db')}",
+            "DB_POOL_SIZE": str(THREADS),
+        })
+        migrations.upgrade(self.engine, Base.metadata)
+        database.DBSession.configure(bind=self.engine)
+        db_session = database.DBSession()
+        db_session.add(User(id=1, email="org@localmail.com", role=Role.organizer, login_fail_count=0))
+        db_session.flush()
+        event_obj = Event(id=1, title="Flash sale", cent_price=1000, currency_code="GBP",
+                          number_of_tickets=TICKETS, organizer_id=1)
+        db_session.add(event_obj)
+        db_session.flush()
+        InventoryStorage(db_session).allocate(event_obj)
+        db_session.commit()
+        db_session.close()
+
+    def tearDown(self) -> None:
+        database.DBSession.configure(bind=database.engine)
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_event_never_oversells(self):
+        status_codes = []
+        lock = threading.Lock()
+
+        def buy(count):
+            client = app.app.test_client()
+            for _ in range(count):
+                response = client.post("/sold-tickets", json={
+                    "event_id": 1,
+                    "seller_id": 1,
+                    "buyer": {"name": "Joe Blogs", "phone": "+441234567890", "email": "joe@email.com"}
+                })
+                with lock:
+                    status_codes.append((response.status_code, response.json.get("error")))
+
+        threads = [threading.Thread(target=buy, args=(PURCHASES // THREADS,)) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sold = [status for status in status_codes if status[0] == 200]
+        sold_out = [status for status in status_codes if status == (400, "Event sold out.")]
+        self.assertEqual(PURCHASES // THREADS * THREADS, len(sold) + len(sold_out), set(status_codes))
+        self.assertEqual(TICKETS, len(sold))
+        db_session = database.DBSession()
+        self.assertEqual(TICKETS, db_session.query(SoldTicket).count())
+        self.assertEqual(TICKETS, db_session.query(Inventory.sold).filter_by(event_id=1).scalar())
+        db_session.close()
+
+
+class TestConcurrentFirstLogins(TestCase):
+    """First logins with the same Google or Github account at the same time create one user."""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = database.create_engine_from_config({
+            "DATABASE_URL": f"sqlite:///{os.path.join(self.directory.name, 'test.db')}",
+            "DB_POOL_SIZE": str(THREADS),
+        })
+        migrations.upgrade(self.engine, Base.metadata)
+        database.DBSession.configure(bind=self.engine)
+
+    def tearDown(self) -> None:
+        database.DBSession.configure(bind=database.engine)
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_one_user_per_foreign_account(self):
+        user_ids = []
+        barrier = threading.Barrier(THREADS)
+
+        def first_login():
+            db_session = database.DBSession()
+            barrier.wait()
+            user_id, role = UserStorage(db_session).upsert_foreign_user("github-42")
+            db_session.commit()
+            db_session.close()
+            user_ids.append(user_id)
+
+        threads = [threading.Thread(target=first_login) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(THREADS, len(user_ids))
+        self.assertEqual(1, len(set(user_ids)))
+        db_session = database.DBSession()
+        self.assertEqual(1, db_session.query(User).count())
+        db_session.close()
+
+
+class TestConcurrentLoginFailures(TestCase):
+    """Failed logins at the same time are all counted."""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = database.create_engine_from_config({
+            "DATABASE_URL": f"sqlite:///{os.path.join(self.directory.name, 'test.db')}",
+            "DB_POOL_SIZE": str(THREADS),
+        })
+        migrations.upgrade(self.engine, Base.metadata)
+        database.DBSession.configure(bind=self.engine)
+        db_session = database.DBSession()
+        db_session.add(User(id=1, email="org@localmail.com", role=Role.organizer, account_verified=True,
+                            login_fail_count=0, hashed_password=passwords.hash_password("password")))
+        db_session.commit()
+        db_session.close()
+
+    def tearDown(self) -> None:
+        database.DBSession.configure(bind=database.engine)
+        login_throttle.clear()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_no_failure_is_lost(self):
+        errors = []
+        barrier = threading.Barrier(THREADS)
+
+        def log_in():
+            client = app.app.test_client()
+            barrier.wait()
+            response = client.post("/login", json={"email": "org@localmail.com", "password": "wrong"})
+            errors.append(response.json["error"])
+
+        threads = [threading.Thread(target=log_in) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(set(errors), {"Wrong username or password.", "Account blocked."})
+        db_session = database.DBSession()
+        self.assertEqual(errors.count("Wrong username or password."),
+                         db_session.query(User.login_fail_count).filter_by(id=1).scalar())
+        db_session.close()
+
+    def test_failure_count_is_committed_alone(self):
+        """Counting a failure doesn't commit the rest of the request, which then rolls back."""
+        with self.assertRaises(RuntimeError):
+            with app.UsersContext(None) as users:
+                users.storage.get(1).name = "not committed"
+                self.assertEqual(1, users.storage.record_login_failure(1))
+                raise RuntimeError
+        db_session = database.DBSession()
+        self.assertEqual((None, 1), db_session.query(User.name, User.login_fail_count).filter_by(id=1).one())
+        db_session.close()
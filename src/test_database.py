@@ -0,0 +1,73 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from sqlalchemy.pool import StaticPool
+
+import database
+
+
+class TestEngineFactory(TestCase):
+    def test_in_memory_sqlite_shares_one_connection(self):
+        engine = database.create_engine_from_config({})
+        self.assertIsInstance(engine.pool, StaticPool)
+        self.assertEqual(1, engine.execute("PRAGMA foreign_keys").scalar())
+
+    def test_file_sqlite_uses_wal_and_a_real_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = database.create_engine_from_config({
+                "DATABASE_URL": f"sqlite:///{os.path.join(directory, 'test.db')}",
+                "DB_POOL_SIZE": "3",
+            })
+            first = engine.connect()
+            second = engine.connect()
+            for connection in (first, second):
+                self.assertEqual("wal", connection.execute("PRAGMA journal_mode").scalar())
+                self.assertEqual(1, connection.execute("PRAGMA foreign_keys").scalar())
+            self.assertEqual(2, engine.pool.checkedout())
+            self.assertEqual(3, engine.pool.size())
+            first.close()
+            second.close()
+            stats = engine.pool_stats.as_dict()
+            self.assertEqual(2, stats["connects"])
+            self.assertEqual(2, stats["checkouts"])
+            self.assertEqual(2, stats["checkins"])
+            engine.dispose()
+
+    def test_pool_timeouts_are_counted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = database.create_engine_from_config({
+                "DATABASE_URL": f"sqlite:///{os.path.join(directory, 'test.db')}",
+                "DB_POOL_SIZE": "1",
+                "DB_MAX_OVERFLOW": "0",
+                "DB_POOL_TIMEOUT": "0.05",
+            })
+            connection = engine.connect()
+            with self.assertRaises(database.exc.TimeoutError):
+                engine.connect()
+            connection.close()
+            stats = engine.pool_stats.as_dict()
+            self.assertEqual(1, stats["timeouts"])
+            self.assertGreaterEqual(stats["wait_ms_max"], 50)
+            engine.dispose()
+
+
+class TestWaitForDatabase(TestCase):
+    def test_retries_until_the_database_is_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "not_yet", "test.db")
+            engine = database.create_engine_from_config({"DATABASE_URL": f"sqlite:///{path}"})
+            threading.Timer(0.3, os.mkdir, [os.path.dirname(path)]).start()
+            start = time.perf_counter()
+            database.wait_for_database(engine, timeout=5, delay=0.05)
+            self.assertGreaterEqual(time.perf_counter() - start, 0.3)
+            engine.dispose()
+
+    def test_gives_up_after_timeout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = database.create_engine_from_config({
+                "DATABASE_URL": f"sqlite:///{os.path.join(directory, 'missing', 'test.db')}"})
+            with self.assertRaises(database.exc.OperationalError):
+                database.wait_for_database(engine, timeout=0.2, delay=0.05)
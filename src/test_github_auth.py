@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
+
+import github_auth
+import http_client
+from exceptions import InvalidTokenException, ServiceUnavailableException
+
+
+class _GithubServer:
+    """Stand-in for GitHub's /user endpoint. The token decides how it answers."""
+
+    def __init__(self):
+        github_server = self
+        self.hits = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                github_server.hits += 1
+                token = self.headers["Authorization"].split(" ", 1)[1]
+                if token == "slow":
+                    time.sleep(0.5)
+                status, body = {
+                    "good": (200, {"id": 42}),
+                    "other": (200, {"id": 43}),
+                    "broken": (502, {}),
+                }.get(token, (401, {"message": "Bad credentials"}))
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/user"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestGithubTokenCache(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.github = _GithubServer()
+        self.addCleanup(self.github.close)
+        for patch in [
+            mock.patch.object(github_auth, "USER_URL", self.github.url),
+            mock.patch.object(github_auth, "_tokens", github_auth.TokenCache(timer=lambda: self.now)),
+            mock.patch.object(github_auth, "breaker", http_client.CircuitBreaker(
+                failure_threshold=2, reset_timeout=30, clock=lambda: self.now)),
+            mock.patch.object(http_client, "TIMEOUT", 0.2),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_account_is_cached_until_ttl(self):
+        for _ in range(3):
+            self.assertEqual(42, github_auth.token_to_account_id("good"))
+        self.assertEqual(1, self.github.hits)
+        self.now += github_auth.ACCOUNT_TTL + 1
+        self.assertEqual(42, github_auth.token_to_account_id("good"))
+        self.assertEqual(2, self.github.hits)
+
+    def test_tokens_are_cached_separately(self):
+        self.assertEqual(42, github_auth.token_to_account_id("good"))
+        self.assertEqual(43, github_auth.token_to_account_id("other"))
+        self.assertEqual(2, self.github.hits)
+
+    def test_rejected_token_is_cached(self):
+        for _ in range(3):
+            with self.assertRaises(InvalidTokenException):
+                github_auth.token_to_account_id("bad")
+        self.assertEqual(1, self.github.hits)
+        self.assertEqual(2, github_auth.cache_status()["rejected_token_hits"])
+        self.now += github_auth.REJECTED_TTL + 1
+        with self.assertRaises(InvalidTokenException):
+            github_auth.token_to_account_id("bad")
+        self.assertEqual(2, self.github.hits)
+
+    def test_circuit_opens_after_failures(self):
+        for token in ["slow", "broken"]:
+            with self.assertRaises(ServiceUnavailableException):
+                github_auth.token_to_account_id(token)
+        self.assertEqual("open", github_auth.breaker.state)
+        with self.assertRaises(ServiceUnavailableException):
+            github_auth.token_to_account_id("good")
+        self.assertEqual(2, self.github.hits)
+
+        self.now += 31
+        self.assertEqual(42, github_auth.token_to_account_id("good"))
+        self.assertEqual("closed", github_auth.breaker.state)
+
+    def test_failed_trial_keeps_circuit_open(self):
+        for _ in range(2):
+            with self.assertRaises(ServiceUnavailableException):
+                github_auth.token_to_account_id("broken")
+        self.now += 31
+        with self.assertRaises(ServiceUnavailableException):
+            github_auth.token_to_account_id("broken")
+        self.assertEqual("open", github_auth.breaker.state)
+        with self.assertRaises(ServiceUnavailableException):
+            github_auth.token_to_account_id("good")
+        self.assertEqual(3, self.github.hits)
@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase, mock
+
+import rsa
+from google.auth import crypt, jwt
+from google.oauth2 import id_token
+
+import google_auth
+import http_client
+from exceptions import InvalidTokenException
+
+# test_app replaces this with a mock without putting it back, so keep hold of the real one
+verify_oauth2_token = id_token.verify_oauth2_token
+
+
+class _CertServer:
+    """Stand-in for Google's cert endpoint that counts how often it is called."""
+
+    def __init__(self, public_key, max_age):
+        body = json.dumps({"key-1": public_key.save_pkcs1().decode()}).encode()
+        cert_server = self
+        self.hits = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                cert_server.hits += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", f"public, max-age={max_age}, must-revalidate")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/oauth2/v1/certs"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestGoogleTokenVerification(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.public_key, private_key = rsa.newkeys(1024)
+        cls.signer = crypt.RSASigner.from_string(private_key.save_pkcs1().decode(), key_id="key-1")
+
+    def setUp(self):
+        self.now = 1000.0
+        self.certs = _CertServer(self.public_key, max_age=60)
+        self.request = google_auth.CachingRequest(http_client.new_session(), clock=lambda: self.now)
+        self.verify = mock.MagicMock(wraps=verify_oauth2_token)
+        for patch in [
+            mock.patch.object(id_token, "_GOOGLE_OAUTH2_CERTS_URL", self.certs.url),
+            mock.patch.object(id_token, "verify_oauth2_token", self.verify),
+            mock.patch.object(google_auth, "_request", self.request),
+            mock.patch.object(google_auth, "_tokens", google_auth.TokenCache()),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.certs.close)
+
+    def _token(self, sub, lifetime=3600):
+        issued = int(time.time())
+        return jwt.encode(self.signer, {
+            "iss": "accounts.google.com",
+            "aud": google_auth.client_id(),
+            "sub": sub,
+            "iat": issued,
+            "exp": issued + lifetime,
+        }).decode()
+
+    def test_repeated_token_is_verified_once(self):
+        token = self._token("111")
+        for _ in range(5):
+            self.assertEqual("111", google_auth.token_to_account_id(token))
+        self.assertEqual(1, self.verify.call_count)
+        self.assertEqual(1, self.certs.hits)
+        self.assertEqual(4, google_auth.cache_status()["token_hits"])
+
+    def test_certs_are_reused_until_max_age(self):
+        google_auth.token_to_account_id(self._token("111"))
+        google_auth.token_to_account_id(self._token("222"))
+        self.assertEqual(2, self.verify.call_count)
+        self.assertEqual(1, self.certs.hits)
+        self.now += 61
+        google_auth.token_to_account_id(self._token("333"))
+        self.assertEqual(2, self.certs.hits)
+
+    def test_expired_token_is_verified_again(self):
+        token = self._token("111", lifetime=60)
+        google_auth.token_to_account_id(token)
+        with mock.patch.object(google_auth._tokens, "_clock", lambda: time.time() + 120):
+            google_auth.token_to_account_id(token)
+        self.assertEqual(2, self.verify.call_count)
+
+    def test_invalid_token_is_not_cached(self):
+        for _ in range(2):
+            with self.assertRaises(InvalidTokenException):
+                google_auth.token_to_account_id("not a token")
+        self.assertEqual(2, self.verify.call_count)
+
+    def test_cache_control(self):
+        self.assertEqual(60, http_client.max_age({"Cache-Control": "public, max-age=100", "Age": "40"}))
+        self.assertEqual(0, http_client.max_age({"Cache-Control": "no-cache, max-age=100"}))
+        self.assertEqual(0, http_client.max_age({}))
@@ -0,0 +1,119 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine.reflection import Inspector
+
+import migrations
+from database import Base
+
+
+# The schema and some rows of a database created before migrations existed
+BASELINE_SCHEMA = [
+    'CREATE TABLE "user" (id INTEGER NOT NULL, email VARCHAR, hashed_password VARCHAR, role VARCHAR, '
+    'account_verified BOOLEAN, name VARCHAR, login_fail_count INTEGER, foreign_user_id VARCHAR, '
+    'PRIMARY KEY (id), CHECK (account_verified IN (0, 1)))',
+    "CREATE TABLE buyer (id INTEGER NOT NULL, name VARCHAR, phone VARCHAR, email VARCHAR, PRIMARY KEY (id))",
+    "CREATE TABLE event (id INTEGER NOT NULL, title VARCHAR, cent_price INTEGER, currency_code VARCHAR, "
+    'time TIMESTAMP, number_of_tickets INTEGER, organizer_id INTEGER, PRIMARY KEY (id), '
+    'FOREIGN KEY(organizer_id) REFERENCES "user" (id))',
+    "CREATE TABLE resold_event (seller_id INTEGER NOT NULL, event_id INTEGER NOT NULL, number_of_tickets INTEGER, "
+    'PRIMARY KEY (seller_id, event_id), FOREIGN KEY(seller_id) REFERENCES "user" (id), '
+    "FOREIGN KEY(event_id) REFERENCES event (id))",
+    "CREATE TABLE sold_ticket (id INTEGER NOT NULL, event_id INTEGER, buyer_id INTEGER, seller_id INTEGER, "
+    "PRIMARY KEY (id), FOREIGN KEY(event_id) REFERENCES event (id), FOREIGN KEY(buyer_id) REFERENCES buyer (id), "
+    'FOREIGN KEY(seller_id) REFERENCES "user" (id))',
+]
+BASELINE_ROWS = [
+    'INSERT INTO "user" (id, email, role, login_fail_count) VALUES '
+    "(1, 'org@localmail.com', 'organizer', 0), (2, 'res@localmail.com', 'reseller', 0)",
+    "INSERT INTO event (id, title, cent_price, currency_code, time, number_of_tickets, organizer_id) "
+    "VALUES (1, 'Old concert', 1000, 'GBP', '2030-01-01 20:00:00.000000', 10, 1)",
+    "INSERT INTO resold_event (seller_id, event_id, number_of_tickets) VALUES (2, 1, 3)",
+    "INSERT INTO buyer (id, name, phone, email) VALUES (1, 'Joe Blogs', '+441234567890', 'joe@email.com')",
+    "INSERT INTO sold_ticket (id, event_id, buyer_id, seller_id) VALUES (1, 1, 1, 1), (2, 1, 1, 2)",
+]
+
+
+class TestMigrations(TestCase):
+    def setUp(self) -> None:
+        self.engine = create_engine("sqlite:///:memory:")
+
+    def index_names(self, table):
+        return {index["name"] for index in Inspector.from_engine(self.engine).get_indexes(table)}
+
+    def test_new_database_is_stamped_latest(self):
+        migrations.upgrade(self.engine, Base.metadata)
+        with self.engine.connect() as connection:
+            self.assertEqual(migrations.LATEST_VERSION, migrations.current_version(connection))
+        self.assertIn("ix_user_email", self.index_names("user"))
+
+    def test_existing_database_is_upgraded_in_place(self):
+        """A database created before migrations existed has no indexes and no schema_version table."""
+        for statement in BASELINE_SCHEMA + BASELINE_ROWS:
+            self.engine.execute(text(statement))
+
+        migrations.upgrade(self.engine, Base.metadata)
+
+        with self.engine.connect() as connection:
+            self.assertEqual(migrations.LATEST_VERSION, migrations.current_version(connection))
+        self.assertEqual({"ix_user_email", "ix_user_foreign_user_id"}, self.index_names("user"))
+        self.assertEqual({"ix_sold_ticket_event_id", "ix_sold_ticket_buyer_id", "ix_sold_ticket_seller_id"},
+                         self.index_names("sold_ticket"))
+        self.assertEqual({"ix_event_time", "ix_event_organizer_id_time", "ix_event_currency_code_time",
+                          "ix_event_cent_price"}, self.index_names("event"))
+
+        def rows(query):
+            return [tuple(row) for row in self.engine.execute(text(query))]
+
+        self.assertEqual([(1, "org@localmail.com", 0), (2, "res@localmail.com", 0)],
+                         rows('SELECT id, email, token_version FROM "user" ORDER BY id'))
+        self.assertEqual([(1, "Old concert", 1000, 10, 1, 0)],
+                         rows("SELECT id, title, cent_price, number_of_tickets, organizer_id, version FROM event"))
+        self.assertEqual([(2, 1, 3)], rows("SELECT seller_id, event_id, number_of_tickets FROM resold_event"))
+        self.assertEqual([(1, 1, 1, 1), (2, 1, 1, 2)],
+                         rows("SELECT id, event_id, buyer_id, seller_id FROM sold_ticket ORDER BY id"))
+        self.assertEqual([(1, 7, 1), (2, 3, 1)],
+                         rows("SELECT seller_id, allocated, sold FROM inventory WHERE event_id = 1 ORDER BY seller_id"))
+        self.assertEqual([(1,)], rows("SELECT rowid FROM event_search WHERE event_search MATCH 'concert'"))
+
+    def test_upgrade_is_idempotent(self):
+        migrations.upgrade(self.engine, Base.metadata)
+        migrations.upgrade(self.engine, Base.metadata)
+        with self.engine.connect() as connection:
+            self.assertEqual(migrations.LATEST_VERSION, migrations.current_version(connection))
+
+    def test_token_version_is_added_to_existing_users(self):
+        migrations.upgrade(self.engine, Base.metadata)
+        self.engine.execute(text('ALTER TABLE "user" DROP COLUMN token_version'))
+        self.engine.execute(text("UPDATE schema_version SET version = 3"))
+        self.engine.execute(text('INSERT INTO "user" (email) VALUES (\'old@localmail.com\')'))
+
+        migrations.upgrade(self.engine, Base.metadata)
+
+        self.assertEqual(0, self.engine.execute(text('SELECT token_version FROM "user"')).scalar())
+
+    def test_versions_are_added_to_existing_events(self):
+        migrations.upgrade(self.engine, Base.metadata)
+        self.engine.execute(text("ALTER TABLE event DROP COLUMN version"))
+        self.engine.execute(text("DROP TABLE collection_version"))
+        self.engine.execute(text("UPDATE schema_version SET version = 5"))
+        self.engine.execute(text("INSERT INTO event (title) VALUES ('Old event')"))
+
+        migrations.upgrade(self.engine, Base.metadata)
+
+        self.assertEqual(0, self.engine.execute(text("SELECT version FROM event")).scalar())
+        self.assertIn("collection_version", Inspector.from_engine(self.engine).get_table_names())
+
+    def test_existing_event_titles_are_indexed_for_search(self):
+        migrations.upgrade(self.engine, Base.metadata)
+        for trigger in ["event_search_insert", "event_search_update", "event_search_delete"]:
+            self.engine.execute(text(f"DROP TRIGGER {trigger}"))
+        self.engine.execute(text("DROP TABLE event_search"))
+        self.engine.execute(text("INSERT INTO event (title) VALUES ('Old concert')"))
+        self.engine.execute(text("UPDATE schema_version SET version = 7"))
+
+        migrations.upgrade(self.engine, Base.metadata)
+
+        self.engine.execute(text("INSERT INTO event (title) VALUES ('New concert')"))
+        matches = self.engine.execute(text("SELECT rowid FROM event_search WHERE event_search MATCH 'concert'"))
+        self.assertEqual([1, 2], sorted(row[0] for row in matches))
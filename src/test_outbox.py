@@ -0,0 +1,133 @@
+import datetime
+import os
+import socket
+import time
+from unittest import TestCase, mock
+
+from aiosmtpd.controller import Controller
+
+import app
+import database
+import outbox
+from database import EmailOutbox
+
+
+class _Mailbox:
+    """aiosmtpd handler keeping the messages it receives along with the client's address."""
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((session.peer, envelope.rcpt_tos, envelope.content.decode()))
+        return "250 Message accepted for delivery"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestOutbox(TestCase):
+    def setUp(self) -> None:
+        database.recreate_db()
+        self.mailbox = _Mailbox()
+        self.smtp_port = _free_port()
+        self.smtp = None
+        self.start_smtp()
+        self.addCleanup(self.stop_smtp)
+        self.now = datetime.datetime(2030, 1, 1)
+        self.sender = outbox.OutboxSender(batch_size=3, clock=lambda: self.now)
+        self.addCleanup(self.sender.stop)
+        patch = mock.patch.dict(os.environ, {
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(self.smtp_port),
+            "SECRET_KEY": "SECRET_KEY",
+            "SECURITY_PASSWORD_SALT": "SECURITY_PASSWORD_SALT",
+            "APP_URL": "http://localhost:5000",
+        })
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def start_smtp(self):
+        self.smtp = Controller(self.mailbox, hostname="127.0.0.1", port=self.smtp_port)
+        self.smtp.start()
+
+    def stop_smtp(self):
+        if self.smtp:
+            self.smtp.stop()
+            self.smtp = None
+
+    def queue(self, count):
+        db_session = database.get_db_session()
+        for number in range(count):
+            outbox.Outbox(db_session).add(f"user{number}@localmail.com", "Hello", f"Message {number}")
+        for email in db_session.query(EmailOutbox):
+            email.next_attempt_at = self.now
+        db_session.commit()
+        db_session.close()
+
+    def pending(self):
+        db_session = database.get_db_session()
+        emails = db_session.query(EmailOutbox).all()
+        db_session.close()
+        return emails
+
+    def test_register_only_queues_the_email(self):
+        with mock.patch.dict(os.environ, {"SMTP_PORT": str(_free_port())}):  # Nothing listening
+            response = app.app.test_client().post("/register", json={
+                "email": "new@localmail.com", "password": "password", "role": "organizer"})
+        self.assertEqual(200, response.status_code, response.json)
+        emails = self.pending()
+        self.assertEqual(1, len(emails))
+        self.assertEqual("new@localmail.com", emails[0].recipient)
+        self.assertIn("http://localhost:5000/activate/", emails[0].body)
+
+    def test_batches_share_one_connection(self):
+        self.queue(7)
+        self.assertEqual([3, 3, 1, 0], [self.sender.send_batch() for _ in range(4)])
+        self.assertEqual(7, len(self.mailbox.messages))
+        self.assertEqual(1, len({peer for peer, _, _ in self.mailbox.messages}))
+        self.assertEqual(["user0@localmail.com"], self.mailbox.messages[0][1])
+        self.assertIn("Subject: Hello", self.mailbox.messages[0][2])
+        self.assertEqual(1, self.sender.connections)
+        self.assertEqual([], self.pending())
+
+    def test_failed_sends_back_off(self):
+        self.queue(2)
+        self.stop_smtp()
+        self.assertEqual(0, self.sender.send_batch())
+        email = [email for email in self.pending() if email.attempts][0]
+        self.assertEqual(self.now + datetime.timedelta(seconds=outbox.BACKOFF), email.next_attempt_at)
+        self.assertTrue(email.last_error)
+
+        self.start_smtp()
+        self.assertEqual(1, self.sender.send_batch())  # The email that wasn't tried yet
+        self.assertEqual(0, self.sender.send_batch())
+        self.now += datetime.timedelta(seconds=outbox.BACKOFF)
+        self.assertEqual(1, self.sender.send_batch())
+        self.assertEqual([], self.pending())
+        status = self.sender.status()
+        self.assertEqual((0, 2, 1), (status["pending"], status["sent"], status["failed_attempts"]))
+
+    def test_gives_up_after_max_attempts(self):
+        self.queue(1)
+        self.stop_smtp()
+        sender = outbox.OutboxSender(max_attempts=2, clock=lambda: self.now)
+        for _ in range(2):
+            sender.send_batch()
+            self.now += datetime.timedelta(seconds=outbox.MAX_BACKOFF)
+        self.assertIsNone(self.pending()[0].next_attempt_at)
+        self.assertEqual(1, sender.status()["given_up"])
+
+    def test_background_sender_is_woken_by_commits(self):
+        sender = outbox.OutboxSender(poll_interval=60, clock=lambda: self.now)
+        sender.start()
+        self.addCleanup(sender.stop)
+        time.sleep(0.1)  # Let it find the outbox empty and start waiting
+        self.queue(1)
+        deadline = time.monotonic() + 5
+        while not self.mailbox.messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(1, len(self.mailbox.messages))
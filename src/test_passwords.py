@@ -0,0 +1,42 @@
+import threading
+import time
+from unittest import TestCase
+
+import passwords
+from exceptions import ServiceUnavailableException
+
+
+class TestHashPool(TestCase):
+    def test_saturated_pool_sheds(self):
+        pool = passwords.HashPool(workers=1, queue_limit=1)
+        started, release = threading.Event(), threading.Event()
+
+        def slow_hash():
+            started.set()
+            release.wait()
+            return "hash"
+
+        results = []
+        running = threading.Thread(target=lambda: results.append(pool.run(slow_hash)))
+        running.start()
+        started.wait()
+        queued = threading.Thread(target=lambda: results.append(pool.run(lambda: "queued")))
+        queued.start()
+        while pool.in_flight < 2:
+            time.sleep(0.001)
+        with self.assertRaises(ServiceUnavailableException):
+            pool.run(lambda: "shed")
+        release.set()
+        running.join()
+        queued.join()
+        self.assertCountEqual(["hash", "queued"], results)
+        self.assertEqual({"workers": 1, "in_flight": 0, "completed": 2, "rejected": 1}, pool.status())
+        self.assertEqual("ok", pool.run(lambda: "ok"))
+
+    def test_needs_rehash(self):
+        current = passwords.hash_password("password")
+        self.assertTrue(current.startswith(passwords.hash_method() + "$"))
+        self.assertFalse(passwords.needs_rehash(current))
+        self.assertTrue(passwords.needs_rehash("pbkdf2:sha256:1000$salt$hash"))
+        self.assertTrue(passwords.check_password(current, "password"))
+        self.assertFalse(passwords.check_password(current, "wrong"))
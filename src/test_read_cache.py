@@ -0,0 +1,86 @@
+from unittest import TestCase
+
+from flask import Flask, request
+
+import database
+import read_cache
+
+
+class _SharedStore:
+    """Local stand-in for a Redis server, holding the keys the RedisBackend uses."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode()
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, 0)) + 1).encode()
+
+
+class TestReadCache(TestCase):
+    def setUp(self) -> None:
+        self.app = Flask(__name__)
+
+    def request(self, path):
+        context = self.app.test_request_context(path)
+        context.push()
+        self.addCleanup(context.pop)
+        return request
+
+    def commit_invalidation(self, cache, **kwargs):
+        db_session = database.get_db_session()
+        cache.invalidate_after_commit(db_session, **kwargs)
+        db_session.commit()
+        db_session.close()
+
+    def test_workers_sharing_a_store_see_each_others_invalidations(self):
+        store = _SharedStore()
+        worker_1 = read_cache.ReadCache(read_cache.RedisBackend(store))
+        worker_2 = read_cache.ReadCache(read_cache.RedisBackend(store))
+        request = self.request("/events?limit=10")
+        worker_1.put(worker_1.key(request), "events-1", {"events": []})
+        worker_1.put(worker_1.key(request, 5), "event-5-0", {"event": {"id": 5}})
+        self.assertEqual(["events-1", {"events": []}], worker_2.get(worker_2.key(request)))
+
+        self.commit_invalidation(worker_2, event_id=5)
+        self.assertIsNone(worker_1.get(worker_1.key(request, 5)))
+        self.assertIsNotNone(worker_1.get(worker_1.key(request)))
+
+        self.commit_invalidation(worker_2, listing=True)
+        self.assertIsNone(worker_1.get(worker_1.key(request)))
+        self.assertEqual((2, 2, 2), (worker_1.hits + worker_2.hits, worker_1.misses, worker_2.invalidations))
+
+    def test_rolled_back_changes_invalidate_nothing(self):
+        cache = read_cache.ReadCache(read_cache.LocalBackend())
+        request = self.request("/events")
+        cache.put(cache.key(request), "events-1", {"events": []})
+        db_session = database.get_db_session()
+        cache.invalidate_after_commit(db_session, listing=True)
+        db_session.rollback()
+        db_session.commit()
+        db_session.close()
+        self.assertIsNotNone(cache.get(cache.key(request)))
+        self.assertEqual(0, cache.invalidations)
+
+    def test_local_backend_is_bounded(self):
+        cache = read_cache.ReadCache(read_cache.LocalBackend(size=2))
+        request = self.request("/events")
+        for event_id in range(3):
+            cache.put(cache.key(request, event_id), f"event-{event_id}-0", {})
+        self.assertIsNone(cache.get(cache.key(request, 0)))
+        self.assertIsNotNone(cache.get(cache.key(request, 2)))
+        self.assertEqual(1, cache.status()["evictions"])
+
+    def test_unavailable_store_is_bypassed(self):
+        class Down:
+            def get(self, key):
+                raise ConnectionError
+
+        cache = read_cache.ReadCache(read_cache.RedisBackend(Down()))
+        self.assertIsNone(cache.key(self.request("/events")))
+        self.assertEqual(1, cache.errors)
@@ -1,4 +1,4 @@
-from database import SoldTicket, Event, Buyer
+from database import SoldTicket, Event, Buyer, retry_on_conflict, insert_all
 from exceptions import (
     InvalidTokenException,
     InvalidRequestException,
@@ -13,14 +13,22 @@ from exceptions import (
     RoleCantChangeException,
     OneFieldAtATimeException,
     SoldOutException,
-    RemoveTicketFirstException
+    RemoveTicketFirstException,
+    ServiceUnavailableException
 )
 from users import Users, Role
-from events import EventsContext, Events
+from events import EventsContext, Events, invalidate
+from versions import EVENTS
+from inventory import InventoryStorage
+from pagination import Page
+from serializers import TICKET, BUYER
+from streaming import wants_stream, stream_json
 import phonenumbers
 from validate_email import validate_email
 
 
+MAX_BULK_SALE = 100
+
 
 class TicketsContext:
     def __init__(self, request, ticket_id=None, buyer_id=None):
@@ -43,6 +51,8 @@ class Tickets:
     def __init__(self, db_session, users: Users, events: Events, request, ticket_id, buyer_id):
         self.storage = _Storage(db_session)
         self.buyer = _Buyer(db_session)
+        self.db_session = db_session
+        self.inventory = InventoryStorage(db_session)
         self.users = users
         self.events = events
         self.request = request
@@ -54,20 +64,16 @@ class Tickets:
         if self.users.logged_in_user.role != Role.admin:
             raise NotAllowedException
         if self.buyer_id:
-            try:
-                e_dict = vars(self.buyer.get(self.buyer_id))
-            except:
+            row = BUYER.query(self.db_session).filter(Buyer.id == self.buyer_id).first()
+            if row is None:
                 raise UnknownItemException
-
-            e_dict.pop("_sa_instance_state")
-            return {"buyer": e_dict}
+            return {"buyer": BUYER(row)}
+        elif wants_stream(self.request):
+            return stream_json("buyers", lambda db_session: BUYER.query(db_session).order_by(Buyer.id), BUYER.batch)
         else:
-            ret_val = {"buyers": []}
-            for entry in self.buyer.get_all():
-                e_dict = vars(entry)
-                e_dict.pop("_sa_instance_state")
-                ret_val["buyers"].append(e_dict)
-            return ret_val
+            page = Page(self.request, Buyer.id, sort_keys={"email": Buyer.email})
+            rows, cursor = page.fetch(BUYER.query(self.db_session))
+            return page.add_next_link({"buyers": BUYER.batch(self.db_session, rows)}, cursor)
 
     def remove_buyer(self):
         self.users.set_logged_in()
@@ -83,22 +89,78 @@ class Tickets:
 
     def read(self):
         if self.ticket_id:
-            try:
-                e_dict = vars(self.storage.get(self.ticket_id))
-            except:
+            row = TICKET.query(self.db_session).filter(SoldTicket.id == self.ticket_id).first()
+            if row is None:
                 raise UnknownItemException
-            e_dict.pop("_sa_instance_state")
-            return {"ticket": e_dict}
+            return {"ticket": TICKET(row)}
+        elif wants_stream(self.request):
+            return stream_json("tickets", lambda db_session: TICKET.query(db_session).order_by(SoldTicket.id),
+                               TICKET.batch)
         else:
-            ret_val = {"tickets": []}
-            for entry in self.storage.get_all():
-                e_dict = vars(entry)
-                e_dict.pop("_sa_instance_state")
-                ret_val["tickets"].append(e_dict)
-            return ret_val
+            page = Page(self.request, SoldTicket.id, sort_keys={"event_id": SoldTicket.event_id})
+            rows, cursor = page.fetch(TICKET.query(self.db_session))
+            return page.add_next_link({"tickets": TICKET.batch(self.db_session, rows)}, cursor)
 
     def create(self):
+        return retry_on_conflict(self.db_session, self._create)
+
+    def _create(self):
         body = self.request.get_json()
+        event_id, seller_id, pool_seller_id = self._sale_seller(body)
+        buyer_dict = body["buyer"]
+        self._validate_buyer(buyer_dict)
+
+        if not self.inventory.reserve(event_id, pool_seller_id):
+            raise SoldOutException
+        self._tickets_changed(event_id, was_available=True)
+        buyer_obj = Buyer(
+            name=buyer_dict["name"],
+            phone=buyer_dict["phone"],
+            email=buyer_dict["email"]
+        )
+        self.buyer.create(buyer_obj)
+
+        ticket_obj = SoldTicket(
+            event_id=event_id,
+            seller_id=seller_id,
+            buyer_id=buyer_obj.id
+        )
+        self.storage.create(ticket_obj)
+        self.ticket_id = ticket_obj.id
+        return self.read()
+
+    def create_bulk(self):
+        return retry_on_conflict(self.db_session, self._create_bulk)
+
+    def _create_bulk(self):
+        """Sells one ticket to each of a list of buyers, all or nothing, in a single transaction."""
+        body = self.request.get_json()
+        event_id, seller_id, pool_seller_id = self._sale_seller(body)
+        buyer_dicts = body["buyers"]
+        if not buyer_dicts or len(buyer_dicts) > MAX_BULK_SALE:
+            raise InvalidRequestException
+        for buyer_dict in buyer_dicts:
+            self._validate_buyer(buyer_dict)
+
+        if not self.inventory.reserve(event_id, pool_seller_id, count=len(buyer_dicts)):
+            raise SoldOutException
+        self._tickets_changed(event_id, was_available=True)
+        buyer_ids = self.buyer.create_all([
+            {"name": buyer_dict["name"], "phone": buyer_dict["phone"], "email": buyer_dict["email"]}
+            for buyer_dict in buyer_dicts
+        ])
+        tickets = [
+            {"event_id": event_id, "seller_id": seller_id, "buyer_id": buyer_id}
+            for buyer_id in buyer_ids
+        ]
+        self.storage.create_all(tickets)
+        return {"tickets": tickets}
+
+    def _sale_seller(self, body):
+        """
+        Checks the event and seller of a sale. Returns the event id, the seller id and the
+        seller whose inventory row the sale counts against.
+        """
         event_id = body["event_id"]
         event_orm = self.events.storage.get(event_id)
         if not event_orm:
@@ -106,59 +168,54 @@ class Tickets:
 
         if "seller_id" in body:
             seller_id = body["seller_id"]
-            if not self.users.storage.get(seller_id):
+            user_orm = self.users.storage.get(seller_id)
+            if not user_orm:
                 raise InvalidRequestException
+            seller_role = user_orm.role
         else:
             try:
                 self.users.set_logged_in()
+            except ServiceUnavailableException:
+                raise
             except Exception as e:
                 print(e)
                 raise InvalidRequestException
             seller_id = self.users.logged_in_user.user_id
+            seller_role = self.users.logged_in_user.role  # From the token, no need to read the user
 
-        user_orm = self.users.storage.get(seller_id)
-        if user_orm.role == Role.organizer:
-            count = self.storage.ticket_count_for_seller(seller_id=seller_id)
-            resold_events = self.events.resoldEvent.get_by_event(event_id)
-            reseller_count = 0
-            for resold_event in resold_events:
-                reseller_count += resold_event.number_of_tickets
-            if event_orm.number_of_tickets - reseller_count <= count:
-                raise SoldOutException
-        elif user_orm.role == Role.reseller:
-            resold_event = self.events.resoldEvent.get(event_id, seller_id)
-            count = self.storage.ticket_count_for_seller(seller_id=seller_id)
-            if resold_event.number_of_tickets <= count:
-                raise SoldOutException
-        else:
+        if seller_role not in [Role.organizer, Role.reseller]:
             raise NotAllowedException
-        buyer_dict = body["buyer"]
+        pool_seller_id = self.inventory.pool_for_sale(event_orm, seller_id, is_reseller=seller_role == Role.reseller)
+        return event_id, seller_id, pool_seller_id
+
+    def _tickets_changed(self, event_id, was_available):
+        """
+        Bumps the event's version and drops its cached reads. The listings change too when the
+        event sold out or became available again, as they can be filtered on availability.
+        """
+        self.events.storage.bump_version(event_id)
+        listing = was_available != self.inventory.has_availability(event_id)
+        if listing:
+            self.events.versions.bump(EVENTS)
+        invalidate(self.db_session, event_id, listing=listing)
+
+    @staticmethod
+    def _validate_buyer(buyer_dict):
         if not phonenumbers.is_valid_number(phonenumbers.parse(buyer_dict["phone"], None)):
             raise InvalidRequestException
         valid = validate_email(email_address=buyer_dict["email"], check_mx=False)
         if not valid:
             raise InvalidEmailAddress
-        buyer_obj = Buyer(
-            name=buyer_dict["name"],
-            phone=buyer_dict["phone"],
-            email=buyer_dict["email"]
-        )
-        self.buyer.create(buyer_obj)
-
-        ticket_obj = SoldTicket(
-            event_id=event_id,
-            seller_id=seller_id,
-            buyer_id=buyer_obj.id
-        )
-        self.storage.create(ticket_obj)
-        self.ticket_id = ticket_obj.id
-        return self.read()
 
     def remove(self):
         self.users.set_logged_in()
         if self.users.logged_in_user.role != Role.admin:
             raise NotAllowedException
         ret = self.read()
+        ticket_obj = self.storage.get(self.ticket_id)
+        was_available = self.inventory.has_availability(ticket_obj.event_id)
+        self.inventory.release(ticket_obj.event_id, self.inventory.pool_for_refund(ticket_obj))
+        self._tickets_changed(ticket_obj.event_id, was_available)
         self.storage.remove(self.ticket_id)
         return {**ret, "message": "Ticket removed."}
 
@@ -169,11 +226,17 @@ class _Storage:
 
     def remove(self, ticket_id):
         self._db_session.delete(self.get(ticket_id))
-        self._db_session.commit()
+        self._db_session.flush()
 
     def create(self, ticket_obj):
         self._db_session.add(ticket_obj)
-        self._db_session.commit()
+        self._db_session.flush()
+
+    def create_all(self, tickets):
+        """Inserts ticket rows in one statement, without going through the unit of work. The dicts get their ids."""
+        for ticket, ticket_id in zip(tickets, insert_all(self._db_session, SoldTicket.__table__, tickets)):
+            ticket["id"] = ticket_id
+        self._db_session.flush()
 
     def ticket_count_for_seller(self, seller_id):
         return self._db_session.query(SoldTicket).filter_by(seller_id=seller_id).count()
@@ -187,10 +250,10 @@ class _Storage:
     def update_field(self, ticket_id, field, value):
         ticket = self._db_session.query(SoldTicket).filter_by(id=ticket_id).first()
         setattr(ticket, field, value)
-        self._db_session.commit()
+        self._db_session.flush()
 
-    def commit_changes(self):
-        self._db_session.commit()
+    def flush_changes(self):
+        self._db_session.flush()
 
 
 class _Buyer:
@@ -199,11 +262,17 @@ class _Buyer:
 
     def remove(self, buyer_id):
         self._db_session.delete(self.get(buyer_id))
-        self._db_session.commit()
+        self._db_session.flush()
 
     def create(self, buyer_obj):
         self._db_session.add(buyer_obj)
-        self._db_session.commit()
+        self._db_session.flush()
+
+    def create_all(self, buyers):
+        """Inserts buyer rows in one statement, without going through the unit of work. Returns their ids."""
+        buyer_ids = insert_all(self._db_session, Buyer.__table__, buyers)
+        self._db_session.flush()
+        return buyer_ids
 
     def buyer_count_for_seller(self, seller_id):
         return self._db_session.query(Buyer).filter_by(seller_id=seller_id).count()
@@ -217,7 +286,7 @@ class _Buyer:
     def update_field(self, buyer_id, field, value):
         buyer = self._db_session.query(Buyer).filter_by(id=buyer_id).first()
         setattr(buyer, field, value)
-        self._db_session.commit()
+        self._db_session.flush()
 
-    def commit_changes(self):
-        self._db_session.commit()
+    def flush_changes(self):
+        self._db_session.flush()
@@ -8,18 +8,25 @@ from exceptions import (
     InvalidRequestException,
     WrongUsernameOrPassword,
     EmailNotValidated,
-    AccountBlocked
+    AccountBlocked,
+    ServiceUnavailableException
 )
 import datetime
+import threading
 import jwt
 
-from database import User, DBSession
+from cachetools import TTLCache
+from sqlalchemy import text, event
+from database import User, DBSession, retry_on_conflict
 import os
 import jwt
-import google_auth
-import github_auth
 import emails
-from werkzeug.security import generate_password_hash, check_password_hash
+from outbox import Outbox
+import metrics
+from pagination import Page
+from serializers import USER, MYSELF
+from streaming import wants_stream, stream_json
+import passwords
 from exceptions import InvalidRequestException, RoleCantChangeException, OneFieldAtATimeException
 
 
@@ -35,17 +42,207 @@ class AccessType:
     github = "github"
 
 
+TOKEN_VERSION_TTL = int(os.environ.get("TOKEN_VERSION_TTL", 30))
+MAX_LOGIN_FAILURES = 3
+
+
+class UserCache:
+    """
+    In-process TTL cache of facts about users, such as their token version, that every
+    authenticated request needs. An entry forgotten in this process is reloaded straight away;
+    a change made by another process is seen once the cached entry expires, after at most
+    ttl seconds. A ttl of 0 turns caching off.
+    """
+
+    def __init__(self, ttl=TOKEN_VERSION_TTL, size=100000):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = TTLCache(maxsize=size, ttl=max(ttl, 1))
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load, db_session=None):
+        """
+        Returns the cached value for key, calling load(key) if it isn't cached. If load writes
+        through db_session, the value is cached only once that transaction commits.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = load(key)
+        if value is not None and self._ttl > 0:
+            if db_session is None:
+                self._put(key, value)
+            else:
+                _after_commit(db_session, lambda: self._put(key, value))
+        return value
+
+    def _put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def forget_where(self, predicate):
+        """Forgets the entries whose value matches. Scans the cache, so only for rare changes."""
+        with self._lock:
+            for key in [key for key, value in self._entries.items() if predicate(value)]:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def status(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+token_versions = UserCache()  # User id to token version
+foreign_users = UserCache()  # Google or Github account id to (user id, role)
+
+
+class LoginThrottle:
+    """
+    Emails of accounts known to be blocked, so that logins to them are turned away without
+    reading the user or hashing the password. Entries expire after ttl seconds, which bounds
+    how long an unblock made by another process takes to be seen here.
+    """
+
+    def __init__(self, ttl=TOKEN_VERSION_TTL, size=100000):
+        self._lock = threading.Lock()
+        self._blocked = TTLCache(maxsize=size, ttl=max(ttl, 1))
+        self.rejected = 0
+
+    def is_blocked(self, email):
+        with self._lock:
+            if email in self._blocked:
+                self.rejected += 1
+                return True
+            return False
+
+    def block(self, email):
+        with self._lock:
+            self._blocked[email] = True
+
+    def unblock(self, email):
+        with self._lock:
+            self._blocked.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._blocked.clear()
+
+    def status(self):
+        return {"blocked_emails": len(self._blocked), "rejected": self.rejected}
+
+
+login_throttle = LoginThrottle()
+
+
+def _forget_user(user_id):
+    token_versions.forget(user_id)
+    foreign_users.forget_where(lambda user: user[0] == user_id)
+
+
+def _after_commit(db_session, change):
+    """
+    Calls change() once the session's transaction commits, and never if it rolls back. Cache
+    changes wait for the commit, as until then other requests still read the old rows and
+    would cache them again.
+    """
+    pending = db_session.info.get("user_cache_changes")
+    if pending is None:
+        pending = db_session.info["user_cache_changes"] = []
+        event.listen(db_session, "after_commit", _apply_changes, once=True)
+        event.listen(db_session, "after_rollback", _drop_changes, once=True)
+    pending.append(change)
+
+
+def _apply_changes(db_session):
+    for change in db_session.info.pop("user_cache_changes", ()):
+        change()
+
+
+def _drop_changes(db_session):
+    db_session.info.pop("user_cache_changes", None)
+
+
+metrics.register("user_cache", lambda: {"token_versions": token_versions.status(),
+                                         "foreign_users": foreign_users.status(),
+                                         "login_throttle": login_throttle.status()})
+
+
+class Identity:
+    """
+    The caller of one request. Resolved from the access token the first time it's needed and
+    then shared by everything the request does, however many contexts and checks it goes
+    through. A failed resolution isn't kept, so it raises again if tried again.
+    """
+
+    def __init__(self):
+        self._logged_in_user = None
+        self.resolutions = 0
+
+    def resolve(self, resolve_user):
+        """Returns the LoggedInUser, calling resolve_user() for it only the first time."""
+        if self._logged_in_user is None:
+            self.resolutions += 1
+            self._logged_in_user = resolve_user()
+        return self._logged_in_user
+
+
+class IdentityStats:
+    """How many times requests resolved their caller, which should never be more than once."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.resolutions = 0
+        self.max_per_request = 0
+
+    def record(self, identity):
+        with self._lock:
+            self.requests += 1
+            self.resolutions += identity.resolutions
+            self.max_per_request = max(self.max_per_request, identity.resolutions)
+
+    def status(self):
+        return {"requests": self.requests, "resolutions": self.resolutions, "max_per_request": self.max_per_request}
+
+
+identity_stats = IdentityStats()
+metrics.register("identity", lambda: identity_stats.status())
+
+
 class UsersContext:
+    """
+    Opens the session for a request. Everything done through it is one transaction, committed
+    when the with block exits normally and rolled back if it raises. Storage classes only flush.
+    """
+
     def __init__(self, request, user_id=None):
         self._request = request
         self._user_id = user_id
 
     def __enter__(self):
         self.db_session = DBSession()
-        return Users(self.db_session, self._request, self._user_id)
+        self.identity = Identity()
+        return Users(self.db_session, self._request, self._user_id, self.identity)
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.db_session.close()
+        identity_stats.record(self.identity)
+        try:
+            if exc_type is None:
+                self.db_session.commit()
+            else:
+                self.db_session.rollback()
+        finally:
+            self.db_session.close()
 
 
 class LoggedInUser:
@@ -58,14 +255,17 @@ class LoggedInUser:
 
 class Users:
 
-    def __init__(self, db_session, request, user_id):
+    def __init__(self, db_session, request, user_id, identity=None):
         self.storage = _Storage(db_session)
+        self.outbox = Outbox(db_session)
+        self.db_session = db_session
+        self.identity = identity or Identity()
         self.logged_in_user = LoggedInUser(None, None)
         self.user_id = int(user_id) if user_id else None
         self.request = request
 
     def create_admin_user(self):
-        hashed_password = generate_password_hash(os.environ["ADMIN_PASSWORD"])
+        hashed_password = passwords.hash_password(os.environ["ADMIN_PASSWORD"])
         if self.storage.empty():
             user = User(
                 email=os.environ["INIT_ADMIN_EMAIL"],
@@ -80,22 +280,33 @@ class Users:
     def login_user(self):
         """Used only for email logins."""
         body = self.request.get_json()
+        if login_throttle.is_blocked(body["email"]):
+            raise AccountBlocked
         user_orm = self.storage.get_user_by_email(body["email"])
         if not user_orm:
             raise WrongUsernameOrPassword
-        if user_orm.login_fail_count >= 3:
+        if user_orm.login_fail_count >= MAX_LOGIN_FAILURES:
+            login_throttle.block(user_orm.email)
             raise AccountBlocked
-        if not check_password_hash(user_orm.hashed_password, body["password"]):
-            user_orm.login_fail_count += 1
-            self.storage.commit_changes()
+        if not passwords.check_password(user_orm.hashed_password, body["password"]):
+            if self.storage.record_login_failure(user_orm.id) >= MAX_LOGIN_FAILURES:
+                login_throttle.block(user_orm.email)
             raise WrongUsernameOrPassword
         if not user_orm.account_verified:
             raise EmailNotValidated
         if user_orm.login_fail_count > 0:
             user_orm.login_fail_count = 0
-            self.storage.commit_changes()
+            self.storage.flush_changes()
+        if passwords.needs_rehash(user_orm.hashed_password):
+            try:
+                user_orm.hashed_password = passwords.hash_password(body["password"])
+                self.storage.flush_changes()
+            except ServiceUnavailableException:
+                pass  # Busy, upgrade the hash on a later login
         payload = {
             "user_id": user_orm.id,
+            "role": user_orm.role,
+            "token_version": user_orm.token_version,
             "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=30),
         }
         token = jwt.encode(payload, os.environ["SECRET_KEY"])
@@ -107,7 +318,7 @@ class Users:
         if len(body) != 1:
             raise OneFieldAtATimeException
         if "password" in body:
-            password_hash = generate_password_hash(body["password"])
+            password_hash = passwords.hash_password(body["password"])
             self.update_password(password_hash)
             return {"message": "Password updated."}
         elif "role" in body:
@@ -136,8 +347,8 @@ class Users:
         password = self.request.json["password"]
         if self.storage.email_exists(email):
             raise UserAlreadyExistsException
-        emails.register(email)
-        hashed_password = generate_password_hash(password)
+        emails.register(email, self.outbox)
+        hashed_password = passwords.hash_password(password)
         user = User(
             email=email,
             hashed_password=hashed_password,
@@ -163,69 +374,72 @@ class Users:
 
     def _handle_foreign_account(self, account_id):
         """Will look up the foreign account id in the user table. If it doesn't exist,
-        a user is created. The new user or existing user is set to be the current user."""
-        user = self.storage.get_user_by_foreign_account_id(account_id)
-        self.logged_in_user = LoggedInUser(user.id, user.role)
+        a user is created. Returns the new user or existing user."""
+        user_id, role = foreign_users.get(str(account_id), self.storage.upsert_foreign_user, self.db_session)
+        return LoggedInUser(user_id, role)
 
     def set_logged_in(self):
+        """Sets the current user from the request's token, resolved once per request."""
+        self.logged_in_user = self.identity.resolve(self._resolve_logged_in)
+
+    def _resolve_logged_in(self):
         access_type = self.request.headers["access-type"]
         token = self.request.headers["access-token"]
         if access_type == AccessType.email:
             try:
                 data = jwt.decode(token, os.environ["SECRET_KEY"])
-                user_id = data["user_id"]
+                user_id, role, version = data["user_id"], data["role"], data["token_version"]
             except Exception as e:
                 print(e)
                 raise InvalidTokenException
-            user = self.storage.get(user_id)
-            self.logged_in_user = LoggedInUser(user_id, user.role)
+            if version != token_versions.get(user_id, self.storage.token_version):
+                raise InvalidTokenException  # Revoked, or the user no longer exists
+            return LoggedInUser(user_id, role)
         elif access_type == AccessType.google:
+            import google_auth  # The providers and their client libraries load on first use
             google_account_id = google_auth.token_to_account_id(token)
-            self._handle_foreign_account(google_account_id)
+            return self._handle_foreign_account(google_account_id)
         elif access_type == AccessType.github:
+            import github_auth
             github_account_id = github_auth.token_to_account_id(token)
-            self._handle_foreign_account(github_account_id)
+            return self._handle_foreign_account(github_account_id)
         else:
             raise InvalidTokenException
 
     def read(self):
         self._modify_read_user_check()
         if self.user_id:
-            try:
-                user_dict = vars(self.storage.get(self.user_id))
-            except:
+            row = USER.query(self.db_session).filter(User.id == self.user_id).first()
+            if row is None:
                 raise UnknownItemException
-            user_dict.pop("_sa_instance_state")
-            user_dict.pop("hashed_password")
+            return USER(row)
+        elif wants_stream(self.request):
+            return stream_json("users", _query_user_columns, USER.batch)
         else:
-            user_dict = {"users":[]}
-            for user in self.storage.get_all():
-                entry = vars(user)
-                entry.pop("_sa_instance_state")
-                entry.pop("hashed_password")
-                user_dict["users"].append(entry)
-        return user_dict
+            page = Page(self.request, User.id)
+            rows, cursor = page.fetch(USER.query(self.db_session))
+            return page.add_next_link({"users": USER.batch(self.db_session, rows)}, cursor)
 
     def read_myself(self):
         self.set_logged_in()
-        user_dict = vars(self.storage.get(self.logged_in_user.user_id))
-        user_dict.pop("_sa_instance_state")
-        user_dict.pop("hashed_password")
-        user_dict.pop("account_verified")
-        user_dict.pop("login_fail_count")
-        return user_dict
+        row = MYSELF.query(self.db_session).filter(User.id == self.logged_in_user.user_id).first()
+        return MYSELF(row)
+
+    def read_metrics(self):
+        self.set_logged_in()
+        if self.logged_in_user.role != Role.admin:
+            raise NotAllowedException
+        return metrics.snapshot()
 
     def remove(self):
-        self._modify_read_user_check()
-        user_dict = vars(self.storage.get(self.user_id))
-        user_dict.pop("_sa_instance_state")
-        user_dict.pop("hashed_password")
+        user_dict = self.read()
         self.storage.remove(self.user_id)
         return {"message": "User successfully deleted.", "user": user_dict}
 
     def update_password(self, hashed_password):
         self._modify_read_user_check()
         self.storage.update_field(self.user_id, "hashed_password", hashed_password)
+        self.storage.revoke_tokens(self.user_id)
 
     def update_role(self, user_id_change, new_role):
         if new_role not in [Role.admin, Role.reseller, Role.organizer]:
@@ -236,16 +450,19 @@ class Users:
         if user_orm.role != None:
             raise RoleCantChangeException
         self.storage.update_field(self.user_id, "role", new_role)
+        self.storage.revoke_tokens(self.user_id)
 
     def update_block(self, user_id_change, block):
         if self.logged_in_user.role != Role.admin:
             raise NotAllowedException
         user_orm = self.storage.get(user_id_change)
         if block:
-            user_orm.login_fail_count = 3
+            user_orm.login_fail_count = MAX_LOGIN_FAILURES
+            self.storage.revoke_tokens(user_id_change)
         else:
             user_orm.login_fail_count = 0
-        self.storage.commit_changes()
+            login_throttle.unblock(user_orm.email)
+        self.storage.flush_changes()
 
     def _modify_read_user_check(self):
         self.set_logged_in()
@@ -262,32 +479,67 @@ class Users:
                 raise NotAllowedException
 
 
+def _query_user_columns(db_session):
+    return USER.query(db_session).order_by(User.id)
+
+
 class _Storage:
     def __init__(self, db_session):
         self._db_session = db_session
 
     def remove(self, user_id):
         self._db_session.delete(self.get(user_id))
-        self._db_session.commit()
+        self._db_session.flush()
+        _after_commit(self._db_session, lambda: _forget_user(user_id))
 
     def create(self, user_obj):
         self._db_session.add(user_obj)
-        self._db_session.commit()
+        self._db_session.flush()
 
     def get(self, user_id):
-        return self._db_session.query(User).filter_by(id=user_id).first()
+        # By primary key, so a user already loaded by the request comes from the session
+        return self._db_session.query(User).get(user_id)
 
     def get_all(self):
         return self._db_session.query(User)
 
     def update_field(self, user_id, field, value):
-        user = self._db_session.query(User).filter_by(id=user_id).first()
+        user = self.get(user_id)
         setattr(user, field, value)
-        self._db_session.commit()
+        self._db_session.flush()
         return user
 
-    def commit_changes(self):
-        self._db_session.commit()
+    def flush_changes(self):
+        self._db_session.flush()
+
+    def token_version(self, user_id):
+        return self._db_session.query(User.token_version).filter_by(id=user_id).scalar()
+
+    def revoke_tokens(self, user_id):
+        """Invalidates the user's login tokens issued so far."""
+        self._db_session.query(User).filter_by(id=user_id).update(
+            {User.token_version: User.token_version + 1}, synchronize_session="fetch")
+        _after_commit(self._db_session, lambda: _forget_user(user_id))
+
+    def record_login_failure(self, user_id):
+        """
+        Counts a failed login with one atomic UPDATE, so concurrent failures are never lost.
+        It must be kept even though the request then fails and rolls back, so it is committed
+        in a transaction of its own rather than the request's. Returns the new failure count.
+        """
+        def increment():
+            params = {"user_id": user_id}
+            with self._db_session.get_bind().begin() as connection:
+                if self._supports_returning():
+                    return connection.execute(text(
+                        'UPDATE "user" SET login_fail_count = login_fail_count + 1 WHERE id = :user_id '
+                        'RETURNING login_fail_count'), params).scalar()
+                connection.execute(text(
+                    'UPDATE "user" SET login_fail_count = login_fail_count + 1 WHERE id = :user_id'), params)
+                return connection.execute(text(
+                    'SELECT login_fail_count FROM "user" WHERE id = :user_id'), params).scalar()
+
+        return retry_on_conflict(None, increment)
 
     def empty(self):
         """Returns true if no users."""
@@ -310,18 +562,33 @@ class _Storage:
     def mark_verified(self, email):
         user = self._db_session.query(User).filter_by(email=email).first()
         setattr(user, "account_verified", True)
-        self._db_session.commit()
+        self._db_session.flush()
 
     def get_user_by_email(self, email) -> User:
         user = self._db_session.query(User).filter_by(email=email).first()
         return user
 
-    def get_user_by_foreign_account_id(self, foreign_user_id) -> User:
-        if self._db_session.query(User).filter_by(foreign_user_id=foreign_user_id).count() == 0:
-            user = User(foreign_user_id=foreign_user_id)
-            self.create(user)
-        user = self._db_session.query(User).filter_by(foreign_user_id=foreign_user_id).first()
-        return user
+    def _supports_returning(self):
+        dialect = self._db_session.get_bind().dialect
+        return dialect.name == "postgresql" or dialect.dbapi.sqlite_version_info >= (3, 35)
+
+    def upsert_foreign_user(self, foreign_user_id):
+        """
+        Returns (id, role) of the user for a foreign account, creating the user if there is none.
+        One statement, and safe against concurrent first logins thanks to the unique index on
+        foreign_user_id.
+        """
+        if self._supports_returning():
+            row = self._db_session.execute(text(
+                'INSERT INTO "user" (foreign_user_id, token_version) VALUES (:foreign_user_id, 0) '
+                'ON CONFLICT (foreign_user_id) DO UPDATE SET foreign_user_id = excluded.foreign_user_id '
+                'RETURNING id, role'), {"foreign_user_id": foreign_user_id}).first()
+        else:  # SQLite before 3.35 has no RETURNING
+            self._db_session.execute(text(
+                'INSERT INTO "user" (foreign_user_id, token_version) VALUES (:foreign_user_id, 0) '
+                'ON CONFLICT (foreign_user_id) DO NOTHING'), {"foreign_user_id": foreign_user_id})
+            row = self._db_session.query(User.id, User.role).filter_by(foreign_user_id=foreign_user_id).one()
+        return row.id, row.role
 
     def get_user_by_foreign_user_id(self, email) -> User:
         user = self._db_session.query(User).filter_by(email=email).first()
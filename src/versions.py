@@ -0,0 +1,26 @@
+"""
+Collection versions, bumped in the transaction that changes a collection's listing.
+
+Together with the version of each event they let GET requests be answered with 304 Not
+Modified from one small read, see etags.py.
+"""
+from sqlalchemy import text
+
+from database import CollectionVersion
+
+EVENTS = "events"
+
+
+class VersionStorage:
+    def __init__(self, db_session):
+        self._db_session = db_session
+
+    def get(self, name):
+        version = self._db_session.query(CollectionVersion.version).filter_by(name=name).scalar()
+        return version or 0
+
+    def bump(self, name):
+        """One atomic statement, creating the row the first time."""
+        self._db_session.execute(text(
+            "INSERT INTO collection_version (name, version) VALUES (:name, 1) "
+            "ON CONFLICT (name) DO UPDATE SET version = collection_version.version + 1"), {"name": name})